@@ -0,0 +1,70 @@
+"""Measure Alert.from_json decode throughput and memory.
+
+    python benchmarks/alert_decode.py --violations 5000 --history 10
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from watchtower.alert import alert as alert_mod
+from watchtower.alert.alert import Alert
+
+
+def build_json(n_violations, history_len):
+    return json.dumps({
+        'fqid': 'ioda.region.bench',
+        'name': 'bench',
+        'level': 'critical',
+        'time': 1577836800,
+        'expression': 'darknet.ucsd-nt.geo.*.uniq_src_ip',
+        'history_expression': 'darknet.ucsd-nt.geo.*.uniq_src_ip.history',
+        'method': 'median',
+        'violations': [{
+            'expression': 'darknet.ucsd-nt.geo.%d.uniq_src_ip' % i,
+            'condition': '< 0.25',
+            'value': 10.0,
+            'history_value': 100.0,
+            'history': [100.0 + j for j in range(history_len)],
+            'time': 1577836800,
+        } for i in range(n_violations)],
+    }).encode()
+
+
+def bench(name, msg, n_violations, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        Alert.from_json(msg)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    alert = Alert.from_json(msg)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del alert
+
+    print("%-8s %10.1f alerts/s %12.0f violations/s %10.1f KiB/alert" %
+          (name, repeat / elapsed, repeat * n_violations / elapsed, size / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--violations', type=int, default=1000)
+    parser.add_argument('--history', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=50)
+    opts = parser.parse_args()
+
+    msg = build_json(opts.violations, opts.history)
+    print("message size: %.1f KiB" % (len(msg) / 1024))
+
+    loads = alert_mod._json_loads
+    alert_mod._json_loads = json.loads
+    bench('json', msg, opts.violations, opts.repeat)
+    if loads is not json.loads:
+        alert_mod._json_loads = loads
+        bench('orjson', msg, opts.violations, opts.repeat)
+
+
+if __name__ == '__main__':
+    main()
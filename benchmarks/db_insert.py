@@ -0,0 +1,105 @@
+"""Compare DatabaseConsumer ingestion strategies.
+
+Writes the same synthetic alerts using per-alert inserts (the original
+DatabaseConsumer behaviour), batched inserts and, when the database is
+PostgreSQL, COPY, and reports rows/s for each.
+
+    python benchmarks/db_insert.py --alerts 2000 --violations 50
+    python benchmarks/db_insert.py --db-config \\
+        '{"drivername": "postgresql", "host": "localhost", "databasename": "wt"}'
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from watchtower.alert.alert import Alert, Violation
+from watchtower.alert.consumers.database import DatabaseConsumer
+
+
+def build_alerts(n_alerts, n_violations):
+    alerts = []
+    for i in range(n_alerts):
+        violations = [
+            Violation(expression='darknet.ucsd-nt.geo.%d.uniq_src_ip' % j,
+                      condition='< 0.25', value=10.0 + j, history_value=100.0,
+                      history=None, time=1577836800 + i * 300,
+                      meta={'meta_type': 'country', 'meta_code': str(j),
+                            'fqid': 'geo.netacuity.%d' % j})
+            for j in range(n_violations)
+        ]
+        alerts.append(Alert(fqid='bench.alert', name='bench', level='critical',
+                            time=1577836800 + i * 300, expression='bench.*',
+                            history_expression='bench.history.*',
+                            method='median', violations=violations))
+    return alerts
+
+
+def new_consumer(db_config, **extra):
+    cfg = dict(db_config)
+    cfg.update(extra)
+    cons = DatabaseConsumer(cfg)
+    cons.start()
+    # start each run from an empty table
+    with cons.engine.connect() as conn:
+        conn.execute(cons.t_alert.delete())
+    return cons
+
+
+def run_per_alert(db_config, alerts):
+    cons = new_consumer(db_config)
+    for alert in alerts:
+        with cons.engine.connect() as conn:
+            conn.execute(cons.t_alert.insert().values(cons._build_alert_rows(alert)))
+
+
+def run_batched(db_config, alerts, mode, flush_rows):
+    cons = new_consumer(db_config, insert_mode=mode, flush_rows=flush_rows,
+                        flush_interval=3600)
+    cons.handle_alerts(alerts)
+    cons.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alerts', type=int, default=1000)
+    parser.add_argument('--violations', type=int, default=20)
+    parser.add_argument('--flush-rows', type=int, default=5000)
+    parser.add_argument('--db-config', default=None,
+                        help='DatabaseConsumer config as JSON (default: temporary sqlite file)')
+    opts = parser.parse_args()
+
+    tmpdir = None
+    if opts.db_config:
+        db_config = json.loads(opts.db_config)
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        db_config = {'host': os.path.join(tmpdir.name, 'bench.db')}
+
+    alerts = build_alerts(opts.alerts, opts.violations)
+    n_rows = opts.alerts * opts.violations
+
+    runs = [
+        ('per-alert insert', lambda: run_per_alert(db_config, alerts)),
+        ('batched insert', lambda: run_batched(db_config, alerts, 'insert',
+                                               opts.flush_rows)),
+    ]
+    if db_config.get('drivername', 'sqlite').startswith('postgresql'):
+        runs.append(('copy', lambda: run_batched(db_config, alerts, 'copy',
+                                                 opts.flush_rows)))
+
+    for name, fn in runs:
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        print("%-18s %8d rows %8.2fs %12.0f rows/s" %
+              (name, n_rows, elapsed, n_rows / elapsed))
+
+    if tmpdir:
+        tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
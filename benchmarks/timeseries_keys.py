@@ -0,0 +1,96 @@
+"""Measure TimeseriesConsumer.handle_alert throughput.
+
+Uses a fake KeyPackage in place of _pytimeseries, so that only the
+consumer's own key building/lookup work is measured. Runs once with the
+key cache disabled (every violation rebuilds its keys and looks them up in
+the KeyPackage) and once with it enabled.
+
+    python benchmarks/timeseries_keys.py --alerts 500 --violations 2000
+"""
+import argparse
+import sys
+import time
+import types
+
+
+class FakeKeyPackage:
+
+    def __init__(self, reset=True):
+        self.keys = {}
+        self.values = []
+
+    def get_key(self, key):
+        return self.keys.get(key)
+
+    def add_key(self, key):
+        self.keys[key] = len(self.values)
+        self.values.append(0)
+        return self.keys[key]
+
+    def set(self, idx, value):
+        self.values[idx] = value
+
+    def flush(self, time):
+        pass
+
+
+class FakeTimeseries:
+
+    def get_backend_by_name(self, name):
+        return name
+
+    def enable_backend(self, backend, opts):
+        pass
+
+    def new_keypackage(self, reset=True):
+        return FakeKeyPackage(reset)
+
+
+sys.modules['_pytimeseries'] = types.SimpleNamespace(Timeseries=FakeTimeseries)
+
+from watchtower.alert.alert import Alert, Violation  # noqa: E402
+from watchtower.alert.consumers.timeseries import TimeseriesConsumer  # noqa: E402
+
+
+def build_alerts(n_alerts, n_violations):
+    alerts = []
+    for i in range(n_alerts):
+        violations = [
+            Violation(expression='darknet.ucsd-nt.geo.%d.uniq_src_ip' % j,
+                      condition='< 0.25', value=10.0, history_value=100.0,
+                      history=None, time=1577836800 + i * 60,
+                      meta={'meta_type': 'region', 'meta_code': str(j),
+                            'fqid': 'geo.netacuity.NA.US.%d' % j})
+            for j in range(n_violations)
+        ]
+        alert = Alert(fqid='ioda.region.bench', name='bench', level='critical',
+                      time=1577836800 + i * 60, expression='bench.*',
+                      history_expression='bench.history.*', method='median',
+                      violations=violations)
+        alert.violations_annotated = True
+        alerts.append(alert)
+    return alerts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alerts', type=int, default=200)
+    parser.add_argument('--violations', type=int, default=1000)
+    opts = parser.parse_args()
+
+    alerts = build_alerts(opts.alerts, opts.violations)
+    n_viols = opts.alerts * opts.violations
+    for name, cache_size in (('no cache', 0), ('key cache', 100000)):
+        cons = TimeseriesConsumer({'key_cache_size': cache_size})
+        cons.start()
+        start = time.perf_counter()
+        for alert in alerts:
+            cons.handle_alert(alert)
+        elapsed = time.perf_counter() - start
+        print("%-10s %10.1f alerts/s %12.0f violations/s" %
+              (name, opts.alerts / elapsed, n_viols / elapsed))
+
+
+if __name__ == '__main__':
+    main()
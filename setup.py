@@ -21,8 +21,18 @@ setup(name='watchtower.alert',
       license='UCSD-Non-Commerical-Academic',
       packages=find_packages(),
       include_package_data=True,
-      entry_points={'console_scripts': [
-          'watchtower-alert=watchtower.alert.consumer:main'
-      ]},
+      entry_points={
+          'console_scripts': [
+              'watchtower-alert=watchtower.alert.consumer:main',
+              'watchtower-alert-bench=watchtower.alert.bench:main',
+          ],
+          'watchtower.alert.consumers': [
+              'log=watchtower.alert.consumers.log:LogConsumer',
+              'database=watchtower.alert.consumers.database:DatabaseConsumer',
+              'timeseries=watchtower.alert.consumers.timeseries:TimeseriesConsumer',
+              'slack=watchtower.alert.consumers.slack:SlackConsumer',
+              'slack-async=watchtower.alert.consumers.slack:AsyncSlackConsumer',
+          ],
+      },
       install_requires=install_requires
       )
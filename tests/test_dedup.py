@@ -0,0 +1,60 @@
+from watchtower.alert.alert import Alert, Violation
+from watchtower.alert.dedup import DedupIndex, StateTracker
+
+
+def _alert(level, time, expressions=('a.b',), fqid='alert'):
+    violations = [Violation(expression, 'cond', 1, 2, None, time)
+                  for expression in expressions]
+    return Alert(fqid, 'name', level, time, 'expr', 'history', 'method',
+                 violations)
+
+
+def _changes(tracker, *alerts):
+    return [(alert.level, alert.time, [v.expression for v in alert.violations])
+            for alert in tracker.changes(list(alerts))]
+
+
+def test_only_level_changes_are_reported():
+    tracker = StateTracker()
+    # unseen entities are taken to be normal
+    assert _changes(tracker, _alert('normal', 10)) == []
+    assert _changes(tracker, _alert('critical', 20)) == \
+        [('critical', 20, ['a.b'])]
+    assert _changes(tracker, _alert('critical', 30)) == []
+    assert _changes(tracker, _alert('normal', 40)) == [('normal', 40, ['a.b'])]
+
+
+def test_changes_hold_only_changed_violations():
+    tracker = StateTracker()
+    tracker.changes([_alert('critical', 10, ('a', 'b'))])
+    assert _changes(tracker, _alert('critical', 20, ('a', 'c'))) == \
+        [('critical', 20, ['c'])]
+
+
+def test_superseded_alert_is_ignored():
+    tracker = StateTracker()
+    tracker.changes([_alert('critical', 10), _alert('normal', 20)])
+    # e.g., a dead letter being retried after newer alerts
+    assert _changes(tracker, _alert('critical', 10)) == []
+    # and it didn't overwrite the newer level
+    assert _changes(tracker, _alert('normal', 30)) == []
+    assert _changes(tracker, _alert('critical', 40)) == \
+        [('critical', 40, ['a.b'])]
+
+
+def test_max_entities():
+    tracker = StateTracker({'max_entities': 2})
+    tracker.changes([_alert('critical', 10, ('a', 'b', 'c'))])
+    assert len(tracker) == 2
+    # the least recently updated entity was forgotten, so is normal again
+    assert _changes(tracker, _alert('critical', 20, ('a',))) == \
+        [('critical', 20, ['a'])]
+
+
+def test_dedup_drops_exact_duplicates():
+    index = DedupIndex()
+    alert = _alert('critical', 10)
+    assert not index.seen(alert)
+    assert index.seen(_alert('critical', 10))
+    assert not index.seen(_alert('normal', 10))
+    assert index.duplicates == 1
@@ -0,0 +1,177 @@
+from watchtower.alert.dispatch import ConsumerWorker, DispatchTicket, OffsetTracker
+
+TP = ('alerts', 0)
+
+
+class Recorder:
+
+    def __init__(self, fail_alerts=False, flush_result=None, fail_flush=False):
+        self.fail_alerts = fail_alerts
+        self.flush_result = flush_result
+        self.fail_flush = fail_flush
+        self.alerts = []
+        self.stopped = False
+
+    def handle_alerts(self, alerts):
+        if self.fail_alerts:
+            raise RuntimeError('handle failed')
+        self.alerts.extend(alerts)
+
+    def flush(self):
+        if self.fail_flush:
+            raise RuntimeError('flush failed')
+        return self.flush_result
+
+    def stop(self):
+        self.stopped = True
+
+
+def _batch(tracker, offset, pending=0):
+    ticket = DispatchTicket({TP: offset}, pending)
+    tracker.add(ticket)
+    return ticket
+
+
+def _barrier(tracker, pending=0):
+    ticket = DispatchTicket({}, pending, barrier=True)
+    tracker.add(ticket)
+    return ticket
+
+
+def test_ticket_ack_reports_last():
+    ticket = DispatchTicket({TP: 1}, 2)
+    assert not ticket.ack()
+    assert not ticket.done
+    assert ticket.ack()
+    assert ticket.done
+
+
+def test_nothing_committed_without_barrier():
+    tracker = OffsetTracker()
+    _batch(tracker, 1)
+    _batch(tracker, 2)
+    assert tracker.pop_done() == {}
+    assert len(tracker) == 2
+
+
+def test_commit_up_to_done_barrier():
+    tracker = OffsetTracker()
+    _batch(tracker, 1)
+    _barrier(tracker)
+    _batch(tracker, 2)
+    assert tracker.pop_done() == {TP: 1}
+    assert len(tracker) == 1
+    assert tracker.barriers == 0
+
+
+def test_pending_batch_blocks_later_barrier():
+    tracker = OffsetTracker()
+    _batch(tracker, 1)
+    pending = _batch(tracker, 2, pending=1)
+    _batch(tracker, 3)
+    _barrier(tracker)
+    assert tracker.pop_done() == {}
+    pending.ack()
+    assert tracker.pop_done() == {TP: 3}
+
+
+def test_failed_barrier_is_not_committed_past():
+    tracker = OffsetTracker()
+    _batch(tracker, 1)
+    _barrier(tracker, pending=1).fail()
+    _batch(tracker, 2)
+    assert tracker.pop_done() == {}
+    assert tracker.held_back()
+
+    # a later flush that succeeds commits everything before it
+    _barrier(tracker)
+    assert tracker.pop_done() == {TP: 2}
+    assert len(tracker) == 0
+    assert not tracker.held_back()
+
+
+def test_held_back_only_when_failure_blocks():
+    tracker = OffsetTracker()
+    _batch(tracker, 1, pending=1)
+    _barrier(tracker, pending=1).fail()
+    # the batch itself is not done yet
+    assert not tracker.held_back()
+
+
+def _run_worker(consumer, items, **kwargs):
+    worker = ConsumerWorker('test', consumer, 10, **kwargs)
+    worker.start()
+    for kind, payload, ticket in items:
+        worker.submit(kind, payload, ticket)
+    clean = worker.stop()
+    return worker, clean
+
+
+def test_worker_acks_handled_batches():
+    consumer = Recorder()
+    ticket = DispatchTicket({TP: 1}, 1)
+    _, clean = _run_worker(consumer, [('alerts', [1, 2], ticket)])
+    assert clean
+    assert ticket.done and not ticket.failed
+    assert consumer.alerts == [1, 2]
+    assert consumer.stopped
+
+
+def test_worker_flush_failure_fails_barrier():
+    ticket = DispatchTicket({}, 1, barrier=True)
+    _, clean = _run_worker(Recorder(fail_flush=True),
+                           [('flush', None, ticket)])
+    assert clean
+    assert ticket.done and ticket.failed
+
+
+def test_worker_held_back_flush_fails_barrier_quietly():
+    ticket = DispatchTicket({}, 1, barrier=True)
+    worker, clean = _run_worker(Recorder(flush_result=False),
+                                [('flush', None, ticket)])
+    assert clean
+    assert ticket.failed
+    assert worker.waiting
+
+
+def test_worker_spools_failed_batch():
+    failures = []
+    ticket = DispatchTicket({TP: 1}, 1)
+    _, clean = _run_worker(
+        Recorder(fail_alerts=True), [('alerts', [1], ticket)],
+        on_failure=lambda *args: failures.append(args))
+    assert clean
+    assert ticket.done
+    assert [(name, kind, items) for name, kind, items, _ in failures] == \
+        [('test', 'alerts', [1])]
+
+
+def test_worker_gives_up_when_batch_cannot_be_spooled():
+    def on_failure(name, kind, items, error):
+        raise error
+    consumer = Recorder(fail_alerts=True)
+    first = DispatchTicket({TP: 1}, 1)
+    second = DispatchTicket({TP: 2}, 1)
+    worker, clean = _run_worker(
+        consumer, [('alerts', [1], first), ('alerts', [2], second)],
+        on_failure=on_failure)
+    assert not clean
+    assert isinstance(worker.error, RuntimeError)
+    # neither batch may be committed
+    assert not first.done and not second.done
+    assert consumer.stopped
+
+
+def test_worker_diverts_batches():
+    consumer = Recorder()
+    diverted = []
+
+    def divert(name, kind, items):
+        diverted.append(items)
+        return items == [1]
+    ticket = DispatchTicket({TP: 2}, 2)
+    _run_worker(consumer, [('alerts', [1], ticket), ('alerts', [2], ticket)],
+                divert=divert)
+    assert diverted == [[1], [2]]
+    assert consumer.alerts == [2]
+    assert ticket.done
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+
+import pytest
+
+from watchtower.alert.spool import DeadLetterSpool
+
+
+@pytest.fixture
+def spool_path(tmp_path):
+    return str(tmp_path / 'spool')
+
+
+def _spool(path, **config):
+    config = dict({'path': path, 'retry_base': 0, 'batch_size': 10,
+                   'max_attempts': 3}, **config)
+    spool = DeadLetterSpool(config)
+    spool.start()
+    return spool
+
+
+def _next(spool, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        batch = spool.next_retry()
+        if batch is not None:
+            return batch
+        time.sleep(0.01)
+    raise AssertionError('no batch was ready for a retry')
+
+
+def _ids(batch):
+    return [item['id'] for item in batch.items]
+
+
+def _add(spool, *ids):
+    spool.add('db', 'alerts', [{'id': i} for i in ids], RuntimeError('boom'))
+
+
+def test_retry_moves_cursor(spool_path):
+    spool = _spool(spool_path)
+    try:
+        assert not spool.failing('db')
+        _add(spool, 1, 2, 3)
+        assert spool.failing('db')
+        batch = _next(spool)
+        assert batch.target == 'db' and batch.kind == 'alerts'
+        assert _ids(batch) == [1, 2, 3]
+        # still failing until the retry is reported done
+        assert spool.failing('db')
+        spool.retry_done(batch)
+        assert not spool.failing('db')
+        assert spool.stats()['retried'] == 3
+    finally:
+        spool.stop()
+
+
+def test_batches_hold_one_kind(spool_path):
+    spool = _spool(spool_path)
+    try:
+        _add(spool, 1)
+        spool.add('db', 'errors', [{'id': 2}])
+        batch = _next(spool)
+        assert (batch.kind, _ids(batch)) == ('alerts', [1])
+        spool.retry_done(batch)
+        batch = _next(spool)
+        assert (batch.kind, _ids(batch)) == ('errors', [2])
+        spool.retry_done(batch)
+    finally:
+        spool.stop()
+
+
+def test_failed_retry_isolates_and_quarantines_poison(spool_path):
+    spool = _spool(spool_path)
+    try:
+        _add(spool, 1, 2, 3)
+        batch = _next(spool)
+        spool.retry_done(batch, RuntimeError('still failing'))
+
+        # records are now retried one at a time. 1 keeps failing until it is
+        # quarantined (the failed batch counts as its first attempt)
+        for _ in range(2):
+            batch = _next(spool)
+            assert _ids(batch) == [1]
+            spool.retry_done(batch, RuntimeError('poison'))
+        assert spool.stats()['quarantined'] == 1
+
+        batch = _next(spool)
+        assert _ids(batch) == [2]
+        _add(spool, 4)
+        spool.retry_done(batch)
+        # back to full batches after a success
+        batch = _next(spool)
+        assert _ids(batch) == [3, 4]
+        spool.retry_done(batch)
+        assert not spool.failing('db')
+    finally:
+        spool.stop()
+
+    with open(os.path.join(spool_path, 'db', 'poison.jsonl')) as fh:
+        poison = [json.loads(line) for line in fh]
+    assert [record['item']['id'] for record in poison] == [1]
+
+
+def test_restart_resumes_at_cursor(spool_path):
+    spool = _spool(spool_path)
+    _add(spool, 1, 2)
+    batch = _next(spool)
+    spool.retry_done(batch)
+    _add(spool, 3)
+    # stopped before 3 was retried (or while it was in flight)
+    spool.stop()
+
+    spool = _spool(spool_path)
+    try:
+        assert spool.failing('db')
+        batch = _next(spool)
+        assert _ids(batch) == [3]
+        spool.retry_done(batch)
+        assert not spool.failing('db')
+        # records added after the restart go to a new segment
+        _add(spool, 4)
+        batch = _next(spool)
+        assert _ids(batch) == [4]
+        spool.retry_done(batch)
+    finally:
+        spool.stop()
+
+    spool = _spool(spool_path)
+    try:
+        assert not spool.failing('db')
+        assert spool.next_retry() is None
+    finally:
+        spool.stop()
+
+
+def test_partial_record_is_not_retried(spool_path):
+    spool = _spool(spool_path)
+    _add(spool, 1)
+    spool.stop()
+    # a crash in the middle of writing a record
+    segment = os.path.join(spool_path, 'db', '%010d.jsonl' % 0)
+    with open(segment, 'ab') as fh:
+        fh.write(b'{"kind": "alerts", "item": {"id"')
+
+    spool = _spool(spool_path)
+    try:
+        batch = _next(spool)
+        assert _ids(batch) == [1]
+        spool.retry_done(batch)
+        time.sleep(0.1)
+        assert spool.next_retry() is None
+    finally:
+        spool.stop()
@@ -1,6 +1,31 @@
+import collections.abc
 import json
 import requests
 
+# use orjson to decode alerts when it is installed, it is several times faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ijson is used (when installed) to incrementally decode very large alerts
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def _json_loads(json_str):
+    if orjson is not None:
+        try:
+            return orjson.loads(json_str)
+        except ValueError:
+            # orjson rejects NaN and Infinity, which json.loads accepts (and
+            # json.dumps produces), so that is still tried
+            pass
+    return json.loads(json_str)
+
+
 # Shut requests up
 import warnings
 warnings.filterwarnings('once', r'.*InsecurePlatformWarning.*')
@@ -12,8 +37,29 @@ class Alert:
     CH_META_API = "https://charthouse.caida.org/data/meta/hierarchical/annotate"
     LEVELS = ['critical', 'warning', 'normal', 'error']
 
+    # shared expression => meta cache (see watchtower.alert.cache.MetaCache)
+    meta_cache = None
+
+    # lazily decoded alerts larger than this (in bytes) are parsed
+    # incrementally with ijson rather than with a single json.loads
+    stream_threshold = 1 << 20
+
+    FIELDS = ('fqid', 'name', 'level', 'time', 'expression',
+              'history_expression', 'method')
+
+    # alerts may carry thousands of violations, so use slots rather than a
+    # per-instance dict. fields are validated once, on construction
+    __slots__ = ('fqid', 'name', 'level', 'time', 'expression',
+                 'history_expression', 'method', 'violations',
+                 'violations_annotated', 'source')
+
     def __init__(self, fqid, name, level, time, expression, history_expression,
                  method, violations=None):
+        self._validate(level, time)
+        if violations is None:
+            violations = []
+        if not all(isinstance(viol, Violation) for viol in violations):
+            raise TypeError('Alert violations must be of type Violation')
         self.fqid = fqid
         self.name = name
         self.level = level
@@ -24,16 +70,85 @@ class Alert:
         self.violations = violations
 
         self.violations_annotated = False
+        # (topic, partition, offset) of the kafka message this came from
+        self.source = None
 
     def __repr__(self):
         return json.dumps(self.as_dict())
 
     @classmethod
-    def from_json(cls, json_str):
-        obj = json.loads(json_str)
-        # convert violations to objects
-        obj['violations'] = [Violation(**viol) for viol in obj['violations']]
-        return Alert(**obj)
+    def _validate(cls, level, time):
+        if level not in cls.LEVELS:
+            raise TypeError('Alert level must be one of %s' % cls.LEVELS)
+        if not isinstance(time, int):
+            raise TypeError('Alert time must be an integer (UTC epoch time)')
+
+    @classmethod
+    def from_json(cls, json_str, lazy=False, skip_history=False):
+        """Decode an alert.
+
+        :param json_str: JSON encoded alert
+        :param bool lazy: only build Violation objects as they are accessed
+                          (see LazyViolations)
+        :param bool skip_history: do not decode the history of violations
+        """
+        if lazy and ijson is not None and len(json_str) >= cls.stream_threshold:
+            return cls._from_stream(json_str, skip_history)
+        return cls.from_dict(_json_loads(json_str), lazy=lazy,
+                             skip_history=skip_history)
+
+    @classmethod
+    def _from_stream(cls, json_str, skip_history):
+        if isinstance(json_str, str):
+            json_str = json_str.encode()
+        obj = {}
+        for prefix, event, value in ijson.parse(json_str, use_float=True):
+            if prefix in cls.FIELDS and event in ('string', 'number', 'null'):
+                obj[prefix] = value
+            elif prefix == 'violations' and event == 'start_array':
+                # the violations are parsed (once) when they are accessed
+                break
+        if len(obj) < len(cls.FIELDS):
+            # the alert fields normally precede the violations. when they
+            # don't, parse the message in one go rather than twice
+            return cls.from_dict(_json_loads(json_str), lazy=True,
+                                 skip_history=skip_history)
+        obj['violations'] = None
+        return cls.from_dict(obj, lazy=True, skip_history=skip_history,
+                             stream=json_str)
+
+    @classmethod
+    def from_dict(cls, obj, lazy=False, skip_history=False, stream=None):
+        """Fast decode path: validates the decoded fields once and then fills
+        the slots directly rather than going through __init__."""
+        try:
+            level = obj['level']
+            time = obj['time']
+            cls._validate(level, time)
+            # convert violations to objects
+            if stream is not None:
+                violations = LazyViolations(stream=stream,
+                                            skip_history=skip_history)
+            elif lazy:
+                violations = LazyViolations(raw=obj['violations'],
+                                            skip_history=skip_history)
+            else:
+                violations = [Violation.from_dict(viol, skip_history)
+                              for viol in obj['violations']]
+            alert = cls.__new__(cls)
+            alert.fqid = obj['fqid']
+            alert.name = obj['name']
+            alert.level = level
+            alert.time = time
+            alert.expression = obj['expression']
+            alert.history_expression = obj['history_expression']
+            alert.method = obj['method']
+        except KeyError as e:
+            raise TypeError('Alert is missing field %s' % e)
+        alert.violations = violations
+        alert.violations_annotated = False
+        alert.source = None
+        return alert
 
     def as_dict(self):
         return {
@@ -47,30 +162,121 @@ class Alert:
             'violations': [v.as_dict() for v in self.violations],
         }
 
+    def with_violations(self, violations):
+        """Copy of this alert holding only the given violations."""
+        alert = self.__class__.__new__(self.__class__)
+        for slot in self.__slots__:
+            setattr(alert, slot, getattr(self, slot))
+        alert.violations = violations
+        return alert
+
     def annotate_violations(self):
-        if self.violations_annotated:
-            return
+        self.annotate_many([self])
+
+    @classmethod
+    def annotate_many(cls, alerts):
+        """Annotate the violations of several alerts using a single meta
+        lookup for all of their (not yet annotated) expressions.
+
+        :param list alerts: Alert objects to annotate
+        """
+        alerts = [a for a in alerts if not a.violations_annotated]
+        expressions = cls._unannotated_expressions(alerts)
+        metas = cls.lookup_metas(expressions) if expressions else {}
+        cls._apply_metas(alerts, metas)
+
+    @classmethod
+    async def annotate_many_async(cls, alerts, session):
+        """Asynchronous version of annotate_many.
+
+        :param list alerts: Alert objects to annotate
+        :param aiohttp.ClientSession session: session used to query Charthouse
+        """
+        alerts = [a for a in alerts if not a.violations_annotated]
+        expressions = cls._unannotated_expressions(alerts)
+        metas = await cls.lookup_metas_async(expressions, session) \
+            if expressions else {}
+        cls._apply_metas(alerts, metas)
+
+    @staticmethod
+    def _unannotated_expressions(alerts):
         # collect all the expressions from violations that don't already have
         # a meta set
         expressions = []
-        for v in self.violations:
-            if v.meta is None:
-                expressions.append(v.expression)
-        if not len(expressions):
-            # nothing to do...
-            self.violations_annotated = True
-            return
+        for alert in alerts:
+            for v in alert.violations:
+                if v.meta is None:
+                    expressions.append(v.expression)
+        return expressions
+
+    @staticmethod
+    def _apply_metas(alerts, metas):
+        # now assign meta to each violation
+        for alert in alerts:
+            for v in alert.violations:
+                if v.meta is None and v.expression in metas:
+                    v.meta = metas[v.expression]
+            alert.violations_annotated = True
+
+    @classmethod
+    def lookup_metas(cls, expressions):
+        """Find the meta for each of the given expressions, using the shared
+        meta cache (if configured) and falling back to a single batch request
+        to Charthouse for the expressions that are not cached.
+
+        :param list expressions: expressions to annotate
+        :return: dict of expression => meta (or None if there is no meta)
+        """
+        expressions = list(dict.fromkeys(expressions))
+        if cls.meta_cache is not None:
+            metas, expressions = cls.meta_cache.get_many(expressions)
+        else:
+            metas = {}
+        if expressions:
+            fetched = cls._fetch_metas(expressions)
+            if cls.meta_cache is not None:
+                cls.meta_cache.put_many(fetched)
+            metas.update(fetched)
+        return metas
+
+    @classmethod
+    async def lookup_metas_async(cls, expressions, session):
+        """Asynchronous version of lookup_metas."""
+        expressions = list(dict.fromkeys(expressions))
+        if cls.meta_cache is not None:
+            metas, expressions = cls.meta_cache.get_many(expressions)
+        else:
+            metas = {}
+        if expressions:
+            data = [('expression[]', expression) for expression in expressions]
+            async with session.post(cls.CH_META_API, data=data) as resp:
+                try:
+                    res = await resp.json(content_type=None)
+                except ValueError as e:
+                    raise RuntimeError('Charthouse annotation failed with JSON decode error: %s' % e)
+            fetched = cls._parse_metas(expressions, res)
+            if cls.meta_cache is not None:
+                cls.meta_cache.put_many(fetched)
+            metas.update(fetched)
+        return metas
+
+    @classmethod
+    def _fetch_metas(cls, expressions):
         # do a batch lookup for efficiency
-        resp = requests.post(self.CH_META_API, {'expression[]': expressions})
+        resp = requests.post(cls.CH_META_API, {'expression[]': expressions})
         try:
             res = resp.json()
         except Exception as e:
             raise RuntimeError('Charthouse annotation failed with JSON decode error: %s' % e.msg)
+        return cls._parse_metas(expressions, res)
+
+    @classmethod
+    def _parse_metas(cls, expressions, res):
         if not res or 'data' not in res or not res['data']:
             raise RuntimeError('Charthouse annotation failed with error: %s' %
                                res['error'] if res else None)
         # build a mapping from v.expression to metas
-        metas = {}
+        metas = dict.fromkeys(expressions)
         for expression in expressions:
             if expression not in res['data'] or res['data'][expression] is None \
                     or 'annotations' not in res['data'][expression] \
@@ -80,18 +286,14 @@ class Alert:
                 if ann['type'] != 'meta':
                     continue
                 if ann['attributes']['type'] == 'geo':
-                    metas[expression] = self._parse_geo_ann(ann)
+                    metas[expression] = cls._parse_geo_ann(ann)
                 elif ann['attributes']['type'] == 'asn':
                     metas[expression] = {
                         'meta_type': 'asn',
                         'fqid': ann['attributes']['fqid'],
                         'meta_code': ann['attributes']['asn']
                     }
-        # now assign meta to each violation
-        for v in self.violations:
-            if v.expression in metas:
-                v.meta = metas[v.expression]
-        self.violations_annotated = True
+        return metas
 
     @staticmethod
     def _parse_geo_ann(ann):
@@ -104,81 +306,82 @@ class Alert:
             'meta_code': ann['attributes'][type]['id']
         }
 
-    @property
-    def fqid(self):
-        return self._fqid
-
-    @fqid.setter
-    def fqid(self, v):
-        self._fqid = v
 
-    @property
-    def name(self):
-        return self._name
+class Error:
+    """An error reported by the watchtower detector in place of an alert
+    (e.g., a failed query).
 
-    @name.setter
-    def name(self, v):
-        self._name = v
+    Errors are either published to their own topic or carry a discriminating
+    level on the alert topic (see decode).
+    """
 
-    @property
-    def level(self):
-        return self._level
+    FIELDS = ('fqid', 'name', 'time', 'expression', 'history_expression',
+              'type', 'message')
 
-    @level.setter
-    def level(self, v):
-        if v not in self.LEVELS:
-            raise TypeError('Alert level must be one of %s' % self.LEVELS)
-        self._level = v
+    __slots__ = FIELDS + ('source',)
 
-    @property
-    def time(self):
-        return self._time
+    def __init__(self, fqid, name, time, expression, history_expression, type,
+                 message):
+        if not isinstance(time, int):
+            raise TypeError('Error time must be an integer (UTC epoch time)')
+        self.fqid = fqid
+        self.name = name
+        self.time = time
+        self.expression = expression
+        self.history_expression = history_expression
+        self.type = type
+        self.message = message
+        # (topic, partition, offset) of the kafka message this came from
+        self.source = None
 
-    @time.setter
-    def time(self, v):
-        if not isinstance(v, int):
-            raise TypeError('Alert time must be an integer (UTC epoch time)')
-        self._time = v
+    def __repr__(self):
+        return json.dumps(self.as_dict())
 
-    @property
-    def expression(self):
-        return self._expression
+    @classmethod
+    def from_json(cls, json_str):
+        return cls.from_dict(_json_loads(json_str))
 
-    @expression.setter
-    def expression(self, v):
-        self._expression = v
+    @classmethod
+    def from_dict(cls, obj):
+        try:
+            return cls(*[obj[field] for field in cls.FIELDS])
+        except KeyError as e:
+            raise TypeError('Error is missing field %s' % e)
 
-    @property
-    def history_expression(self):
-        return self._history_expression
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
 
-    @history_expression.setter
-    def history_expression(self, v):
-        self._history_expression = v
 
-    @property
-    def method(self):
-        return self._method
+def decode(json_str, lazy=False, skip_history=False, error_level=None):
+    """Decode a message from the alert topic, which may carry errors as well
+    as alerts.
 
-    @method.setter
-    def method(self, v):
-        self._method = v
+    :param str error_level: messages whose level is error_level are decoded
+                            as an Error rather than an Alert
+    :return: Alert or Error
+    """
+    if lazy and ijson is not None and len(json_str) >= Alert.stream_threshold:
+        # errors are small, so anything this large is an alert
+        return Alert._from_stream(json_str, skip_history)
+    obj = _json_loads(json_str)
+    if error_level is not None and isinstance(obj, dict) and \
+            obj.get('level') == error_level:
+        return Error.from_dict(obj)
+    return Alert.from_dict(obj, lazy=lazy, skip_history=skip_history)
 
-    @property
-    def violations(self):
-        return self._violations
 
-    @violations.setter
-    def violations(self, v):
-        if not all(isinstance(viol, Violation) for viol in v):
-            raise TypeError('Alert violations must be of type Violation')
-        self._violations = v
+class Violation:
 
+    REQUIRED_FIELDS = ('expression', 'condition', 'value', 'history_value',
+                       'time')
 
-class Violation:
+    __slots__ = ('expression', 'condition', 'value', 'history_value',
+                 'history', 'time', 'meta')
 
     def __init__(self, expression, condition, value, history_value, history, time,
                  meta=None):
+        if history is not None and not isinstance(history, list):
+            raise TypeError('Violation history must be a list')
         self.expression = expression
         self.condition = condition
         self.value = value
@@ -190,6 +393,40 @@ class Violation:
     def __repr__(self):
         return json.dumps(self.as_dict())
 
+    @classmethod
+    def from_dict(cls, obj, skip_history=False):
+        history = None if skip_history else obj['history']
+        if history is not None and not isinstance(history, list):
+            raise TypeError('Violation history must be a list')
+        viol = cls.__new__(cls)
+        viol.expression = obj['expression']
+        viol.condition = obj['condition']
+        viol.value = obj['value']
+        viol.history_value = obj['history_value']
+        viol.history = history
+        viol.time = obj['time']
+        viol.meta = obj.get('meta')
+        return viol
+
+    @classmethod
+    def check_dict(cls, obj, skip_history=False):
+        """Check that from_dict would accept obj, without building a
+        Violation.
+
+        :raises TypeError: if obj is not a valid violation
+        """
+        if not isinstance(obj, dict):
+            raise TypeError('Violation must be an object')
+        for field in cls.REQUIRED_FIELDS:
+            if field not in obj:
+                raise TypeError("Violation is missing field '%s'" % field)
+        if skip_history:
+            return
+        if 'history' not in obj:
+            raise TypeError("Violation is missing field 'history'")
+        if obj['history'] is not None and not isinstance(obj['history'], list):
+            raise TypeError('Violation history must be a list')
+
     def as_dict(self):
         return {
             'expression': self.expression,
@@ -201,60 +438,102 @@ class Violation:
             'meta': self.meta,
         }
 
-    @property
-    def expression(self):
-        return self._expression
-
-    @expression.setter
-    def expression(self, v):
-        self._expression = v
-
-    @property
-    def condition(self):
-        return self._condition
-
-    @condition.setter
-    def condition(self, v):
-        self._condition = v
-
-    @property
-    def value(self):
-        return self._value
 
-    @value.setter
-    def value(self, v):
-        self._value = v
+class LazyViolations(collections.abc.Sequence):
+    """The violations of an alert, built into Violation objects only when
+    they are accessed.
 
-    @property
-    def time(self):
-        return self._time
+    Violations are either decoded from the list of dicts produced by
+    json.loads, or, for very large alerts, incrementally parsed (with ijson)
+    from the raw message on first access, one violation at a time so that
+    only their Violation objects (without history when skip_history is set)
+    are ever held. Decoded violations are cached, and the dicts they were
+    built from released. Malformed violations raise TypeError on access (or
+    validate) rather than on decode.
+    """
 
-    @time.setter
-    def time(self, v):
-        self._time = v
+    __slots__ = ('_raw', '_stream', '_items', '_unbuilt', '_skip_history')
 
-    @property
-    def history_value(self):
-        return self._history_value
+    def __init__(self, raw=None, stream=None, skip_history=False):
+        # entries of raw are released (set to None) as they are built
+        self._raw = raw
+        self._stream = stream
+        self._items = [None] * len(raw) if raw is not None else None
+        self._unbuilt = len(raw) if raw is not None else 0
+        self._skip_history = skip_history
 
-    @history_value.setter
-    def history_value(self, v):
-        self._history_value = v
-
-    @property
-    def history(self):
-        return self._history
-
-    @history.setter
-    def history(self, v):
-        if v is not None and not isinstance(v, list):
-            raise TypeError('Violation history must be a list')
-        self._history = v
+    def _load_stream(self):
+        try:
+            self._items = list(self._parse_stream(self._stream,
+                                                  self._skip_history))
+        except ijson.JSONError:
+            # ijson rejects NaN and Infinity, which json.loads accepts
+            self._items = self._parse_whole(self._stream, self._skip_history)
+        self._stream = None
 
-    @property
-    def meta(self):
-        return self._meta
+    @staticmethod
+    def _parse_whole(data, skip_history):
+        try:
+            raw = _json_loads(data)['violations']
+        except ValueError as e:
+            raise TypeError('Could not decode violations: %s' % e)
+        try:
+            return [Violation.from_dict(obj, skip_history) for obj in raw]
+        except KeyError as e:
+            raise TypeError('Violation is missing field %s' % e)
 
-    @meta.setter
-    def meta(self, meta):
-        self._meta = meta
+    @staticmethod
+    def _parse_stream(data, skip_history):
+        # ijson builds each item natively, which is much faster than
+        # handling the parse events here
+        for obj in ijson.items(data, 'violations.item', use_float=True):
+            try:
+                yield Violation.from_dict(obj, skip_history)
+            except KeyError as e:
+                raise TypeError('Violation is missing field %s' % e)
+
+    def validate(self):
+        """Check that every violation can be decoded. Violations that are
+        parsed from the raw message are built (that is the only way to parse
+        them), the others are only checked.
+
+        :raises TypeError: if a violation is malformed
+        """
+        if self._items is None:
+            self._load_stream()
+            return
+        if not self._unbuilt:
+            return
+        for obj, viol in zip(self._raw, self._items):
+            if viol is None:
+                Violation.check_dict(obj, self._skip_history)
+
+    def __len__(self):
+        if self._items is None:
+            self._load_stream()
+        return len(self._items)
+
+    def __getitem__(self, idx):
+        if self._items is None:
+            self._load_stream()
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self._items)))]
+        viol = self._items[idx]
+        if viol is None:
+            if idx < 0:
+                idx += len(self._items)
+            try:
+                viol = Violation.from_dict(self._raw[idx], self._skip_history)
+            except KeyError as e:
+                raise TypeError('Violation is missing field %s' % e)
+            self._items[idx] = viol
+            # the dict (with its history) is not needed any more
+            self._raw[idx] = None
+            self._unbuilt -= 1
+            if not self._unbuilt:
+                self._raw = None
+        return viol
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
@@ -0,0 +1,418 @@
+"""Offline replay/benchmark harness for the watchtower-alert pipeline.
+
+Feeds alerts (from a JSONL file, or generated) through Consumer's decode,
+annotate and dispatch path using an in-memory kafka source and a local
+stand-in for the Charthouse meta API, and reports throughput, latency and
+peak memory:
+
+    watchtower-alert-bench --alerts 10000 --violations 50 \\
+        --consumers log,database --meta-mix country=4,region=2,asn=1,none=1
+"""
+import argparse
+import http.server
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from .alert import Alert
+from .consumer import Consumer
+
+LEVELS = ['normal', 'warning', 'critical']
+
+
+class BenchMessage:
+    """Stands in for confluent_kafka.Message."""
+
+    __slots__ = ('_value', '_offset')
+
+    def __init__(self, value, offset):
+        self._value = value
+        self._offset = offset
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return 'bench'
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+
+class BenchSource:
+    """In-memory replacement for the kafka consumer. Records when each
+    message was handed out so that end-to-end latency can be measured."""
+
+    def __init__(self, values):
+        self.msgs = [BenchMessage(value, offset)
+                     for offset, value in enumerate(values)]
+        self.pos = 0
+        self.consumed_at = [None] * len(self.msgs)
+
+    @property
+    def exhausted(self):
+        return self.pos >= len(self.msgs)
+
+    def consume(self, num_messages=1, timeout=None):
+        msgs = self.msgs[self.pos:self.pos + num_messages]
+        now = time.perf_counter()
+        for msg in msgs:
+            self.consumed_at[msg.offset()] = now
+        self.pos += len(msgs)
+        return msgs
+
+    def commit(self, offsets=None, asynchronous=True):
+        pass
+
+    def assignment(self):
+        return []
+
+    def pause(self, partitions):
+        pass
+
+    def resume(self, partitions):
+        pass
+
+
+class BenchConsumer(Consumer):
+    """Consumer configured from a dict and fed by a BenchSource."""
+
+    def __init__(self, config, source):
+        self.bench_config = config
+        self.source = source
+        # seconds from being consumed to being dispatched, per alert
+        self.latencies = []
+        super(BenchConsumer, self).__init__('-')
+
+    def _load_config(self):
+        self.config.update(self.bench_config)
+        self._configure_logging()
+
+    def _init_kafka(self):
+        self.kc = self.source
+
+    def _record_latencies(self, alerts):
+        now = time.perf_counter()
+        consumed_at = self.source.consumed_at
+        self.latencies.extend(now - consumed_at[alert.source[2]]
+                              for alert in alerts if alert.source is not None)
+
+    def _dispatch_alerts(self, alerts):
+        super(BenchConsumer, self)._dispatch_alerts(alerts)
+        # with dispatch_workers this measures until the alerts were queued
+        self._record_latencies(alerts)
+
+    async def _flush_alerts_async(self):
+        alerts = self.pending_alerts
+        await super(BenchConsumer, self)._flush_alerts_async()
+        self._record_latencies(alerts)
+
+    def _should_flush_alerts(self, now):
+        # nothing else is coming, so don't wait out annotate_linger
+        if self.pending_alerts and self.source.exhausted:
+            return True
+        return super(BenchConsumer, self)._should_flush_alerts(now)
+
+    def _handle_msgs(self, msgs):
+        # stop once the alerts that are left have been flushed, by the
+        # runtime's own flush path
+        if not msgs and self.source.exhausted and not self.pending_alerts:
+            return False
+        return super(BenchConsumer, self)._handle_msgs(msgs)
+
+
+class MetaStandIn:
+    """Local stand-in for the Charthouse meta annotation API.
+
+    Annotates the expressions built by AlertGenerator: "bench.geo.<level>.<code>"
+    and "bench.asn.<asn>" (anything else has no meta), after an optional
+    delay emulating the round trip to Charthouse.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = 0
+        self.expressions = 0
+        self.server = None
+
+    @staticmethod
+    def annotate(expression):
+        parts = expression.split('.')
+        if len(parts) < 4 or parts[0] != 'bench':
+            return None
+        if parts[1] == 'asn':
+            attributes = {'type': 'asn', 'fqid': 'asn.%s' % parts[2],
+                          'asn': parts[2]}
+        elif parts[1] == 'geo':
+            level, code = parts[2], parts[3]
+            attributes = {'type': 'geo', 'nativeLevel': level,
+                          'fqid': 'geo.%s.%s' % (level, code),
+                          level: {'id': code}}
+        else:
+            return None
+        return {'annotations': [{'type': 'meta', 'attributes': attributes}]}
+
+    def start(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+                expressions = form.get('expression[]', [])
+                stand_in.requests += 1
+                stand_in.expressions += len(expressions)
+                if stand_in.delay:
+                    time.sleep(stand_in.delay)
+                body = json.dumps({'data': {e: stand_in.annotate(e)
+                                            for e in expressions}}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:%d/annotate" % self.server.server_address[1]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AlertGenerator:
+    """Builds synthetic alert messages.
+
+    :param int names: number of distinct alert names
+    :param int violations: violations per alert
+    :param int history: history values per violation
+    :param dict meta_mix: {meta kind: weight}, kinds are the geo levels
+                          (continent, country, region, county), "asn" and
+                          "none" (no meta)
+    :param float duplicates: fraction of messages that repeat an earlier one
+    :param float errors: fraction of messages that are (query) errors
+    """
+
+    def __init__(self, names=10, violations=10, history=0, meta_mix=None,
+                 duplicates=0, errors=0, seed=0):
+        self.names = names
+        self.violations = violations
+        self.history = history
+        self.meta_mix = meta_mix or {'country': 1}
+        self.duplicates = duplicates
+        self.errors = errors
+        self.rand = random.Random(seed)
+
+    def _expression(self, kind, code):
+        if kind == 'asn':
+            return 'bench.asn.%d.signal' % code
+        if kind == 'none':
+            return 'bench.other.%d.signal' % code
+        return 'bench.geo.%s.%d.signal' % (kind, code)
+
+    def _alert(self, i):
+        name = 'bench%d' % (i % self.names)
+        t = 1577836800 + (i // self.names) * 60
+        kinds = self.rand.choices(list(self.meta_mix),
+                                  weights=list(self.meta_mix.values()),
+                                  k=self.violations)
+        return {
+            'fqid': 'bench.%s' % name,
+            'name': name,
+            'level': self.rand.choice(LEVELS),
+            'time': t,
+            'expression': 'bench.*.signal',
+            'history_expression': 'bench.*.signal.history',
+            'method': 'median',
+            'violations': [{
+                'expression': self._expression(kind, j),
+                'condition': '< 0.25',
+                'value': self.rand.random(),
+                'history_value': 1.0,
+                'history': [1.0] * self.history,
+                'time': t,
+            } for j, kind in enumerate(kinds)],
+        }
+
+    def _error(self, i):
+        name = 'bench%d' % (i % self.names)
+        return {
+            'fqid': 'bench.%s' % name,
+            'name': name,
+            'level': 'error',
+            'time': 1577836800 + (i // self.names) * 60,
+            'expression': 'bench.*.signal',
+            'history_expression': 'bench.*.signal.history',
+            'type': 'query',
+            'message': 'Query failed',
+        }
+
+    def generate(self, count):
+        msgs = []
+        for i in range(count):
+            if msgs and self.rand.random() < self.duplicates:
+                msgs.append(self.rand.choice(msgs))
+            elif self.rand.random() < self.errors:
+                msgs.append(json.dumps(self._error(i)).encode())
+            else:
+                msgs.append(json.dumps(self._alert(i)).encode())
+        return msgs
+
+
+def _percentile(values, q):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def _build_config(opts, workdir):
+    config = {
+        'logging': opts.logging,
+        'consumer_group': 'bench',
+        'alert_consumers': opts.consumers,
+        'timer_consumers': [],
+        'error_consumers': opts.consumers,
+        'batch_size': opts.batch_size,
+        'annotate_batch_size': opts.annotate_batch_size,
+        'meta_cache': None if opts.no_meta_cache else {},
+        'metrics': {'profile_signal': None},
+        'dead_letter': {'path': os.path.join(workdir, 'dead-letter')},
+        'consumers': {
+            'database': {
+                'drivername': 'sqlite',
+                'host': os.path.join(workdir, 'bench.db'),
+            },
+            'timeseries': {
+                'backends': ['ascii'],
+                'ascii-opts': '-f %s' % os.path.join(workdir, 'timeseries.txt'),
+            },
+        },
+    }
+    if opts.config:
+        with open(opts.config) as fh:
+            config.update(json.load(fh))
+    return config
+
+
+def run(opts):
+    if opts.input:
+        with open(opts.input, 'rb') as fh:
+            values = [line.rstrip(b'\n') for line in fh if line.strip()]
+        if opts.alerts:
+            values = values[:opts.alerts]
+    else:
+        gen = AlertGenerator(names=opts.names, violations=opts.violations,
+                             history=opts.history,
+                             meta_mix=_parse_mix(opts.meta_mix),
+                             duplicates=opts.duplicates, errors=opts.errors,
+                             seed=opts.seed)
+        values = gen.generate(opts.alerts)
+
+    stand_in = MetaStandIn(delay=opts.meta_delay / 1000)
+    Alert.CH_META_API = stand_in.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix='watchtower-bench-') as workdir:
+            source = BenchSource(values)
+            consumer = BenchConsumer(_build_config(opts, workdir), source)
+            start = time.perf_counter()
+            consumer.run()
+            elapsed = time.perf_counter() - start
+    finally:
+        stand_in.stop()
+
+    latencies = sorted(consumer.latencies)
+    return {
+        'messages': len(values),
+        'alerts': consumer.stats['alerts'],
+        'errors': consumer.stats['errors'],
+        'duplicates': consumer.stats['duplicates'],
+        'elapsed': elapsed,
+        'msgs_per_sec': len(values) / elapsed if elapsed else 0,
+        'latency_p50_ms': 1000 * _percentile(latencies, 0.5),
+        'latency_p99_ms': 1000 * _percentile(latencies, 0.99),
+        'meta_requests': stand_in.requests,
+        'meta_expressions': stand_in.expressions,
+        # kilobytes on linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--input',
+                        help='JSONL file of alert messages (default: generate)')
+    parser.add_argument('-n', '--alerts', type=int, default=10000,
+                        help='Number of messages (with --input, the maximum)')
+    parser.add_argument('--names', type=int, default=10,
+                        help='Distinct alert names to generate')
+    parser.add_argument('--violations', type=int, default=10,
+                        help='Violations per generated alert')
+    parser.add_argument('--history', type=int, default=0,
+                        help='History values per generated violation')
+    parser.add_argument('--meta-mix', default='country=1',
+                        help='Weights of violation meta kinds, e.g., '
+                             'country=4,region=2,asn=1,none=1')
+    parser.add_argument('--duplicates', type=float, default=0,
+                        help='Fraction of messages that repeat an earlier one')
+    parser.add_argument('--errors', type=float, default=0,
+                        help='Fraction of messages that are query errors')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--meta-delay', type=float, default=0,
+                        help='Milliseconds the meta stand-in waits per request')
+    parser.add_argument('-p', '--consumers', default='log',
+                        type=lambda s: s.split(','),
+                        help='Comma-separated plugins to run (log, database, '
+                             'timeseries)')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--annotate-batch-size', type=int, default=100)
+    parser.add_argument('--no-meta-cache', action='store_true')
+    parser.add_argument('-c', '--config',
+                        help='JSON config merged over the bench config')
+    parser.add_argument('--logging', default='CRITICAL')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as a single JSON object')
+    opts = parser.parse_args()
+
+    results = run(opts)
+    if opts.json:
+        print(json.dumps(results))
+        return
+    print("messages:        %d (%d alerts, %d errors, %d duplicates)" %
+          (results['messages'], results['alerts'], results['errors'],
+           results['duplicates']))
+    print("elapsed:         %.2fs" % results['elapsed'])
+    print("throughput:      %.1f msgs/s" % results['msgs_per_sec'])
+    print("latency:         p50 %.2fms, p99 %.2fms" %
+          (results['latency_p50_ms'], results['latency_p99_ms']))
+    print("meta lookups:    %d requests, %d expressions" %
+          (results['meta_requests'], results['meta_expressions']))
+    print("peak RSS:        %.1f MiB" % (results['peak_rss_kb'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
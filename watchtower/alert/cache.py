@@ -0,0 +1,124 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MetaCache:
+    """Bounded TTL cache of Charthouse expression => meta annotations.
+
+    Entries are evicted least-recently-used once `max_size` is reached, and
+    expire after `ttl` seconds (`negative_ttl` for expressions that Charthouse
+    could not annotate). If `path` is set, entries are also written through to
+    a sqlite file so that the cache survives restarts.
+    """
+
+    defaults = {
+        'max_size': 100000,
+        'ttl': 86400,
+        'negative_ttl': 3600,
+        'path': None,
+    }
+
+    def __init__(self, config=None):
+        self.config = dict(self.defaults)
+        if config:
+            self.config.update(config)
+        self.max_size = self.config['max_size']
+        self.ttl = self.config['ttl']
+        self.negative_ttl = self.config['negative_ttl']
+
+        self.hits = 0
+        self.misses = 0
+
+        # expression => (expiry_time, meta)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if self.config['path']:
+            self._open_db(self.config['path'])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _open_db(self, path):
+        logging.info("Loading meta annotation cache from '%s'" % path)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta_cache ("
+                         "expression TEXT PRIMARY KEY, "
+                         "meta TEXT, "
+                         "expires REAL NOT NULL)")
+        now = time.time()
+        self._db.execute("DELETE FROM meta_cache WHERE expires <= ?", (now,))
+        self._db.commit()
+        rows = self._db.execute("SELECT expression, meta, expires FROM meta_cache "
+                                "ORDER BY expires ASC")
+        for expression, meta, expires in rows:
+            self._entries[expression] = (expires, json.loads(meta))
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        logging.info("Loaded %d cached meta annotations" % len(self._entries))
+
+    def get_many(self, expressions):
+        """Look up a list of expressions.
+
+        :param list expressions: expressions to look up
+        :return: tuple of ({expression: meta} for cached expressions,
+                 [expression] for those that need to be looked up)
+        """
+        found = {}
+        missing = []
+        now = time.time()
+        with self._lock:
+            for expression in expressions:
+                entry = self._entries.get(expression)
+                if entry is None or entry[0] <= now:
+                    if entry is not None:
+                        del self._entries[expression]
+                    missing.append(expression)
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(expression)
+                found[expression] = entry[1]
+                self.hits += 1
+        return found, missing
+
+    def put_many(self, metas):
+        """Cache a mapping of expression => meta (None if no meta exists)."""
+        now = time.time()
+        rows = []
+        with self._lock:
+            for expression, meta in metas.items():
+                expires = now + (self.ttl if meta is not None else self.negative_ttl)
+                self._entries[expression] = (expires, meta)
+                self._entries.move_to_end(expression)
+                rows.append((expression, json.dumps(meta), expires))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            if self._db is not None and rows:
+                self._db.executemany("INSERT OR REPLACE INTO meta_cache "
+                                     "(expression, meta, expires) VALUES (?, ?, ?)",
+                                     rows)
+                self._db.commit()
+
+    def prune(self):
+        """Drop expired entries from memory and from the on-disk cache."""
+        now = time.time()
+        with self._lock:
+            expired = [e for e, (expires, _) in self._entries.items() if expires <= now]
+            for expression in expired:
+                del self._entries[expression]
+            if self._db is not None:
+                self._db.execute("DELETE FROM meta_cache WHERE expires <= ?", (now,))
+                self._db.commit()
+        return len(expired)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
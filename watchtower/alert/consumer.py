@@ -1,12 +1,20 @@
 import argparse
+import asyncio
+import concurrent.futures
+import functools
 import json
 import logging
 import os
 import confluent_kafka
 import time
 
-from .alert import Alert
-from .consumers import *
+from .alert import Alert, Error, LazyViolations, decode
+from .cache import MetaCache
+from .dedup import DedupIndex, StateTracker
+from .consumers import AsyncAbstractConsumer, load_consumer, shard_path
+from .dispatch import ConsumerWorker, DispatchTicket, OffsetTracker
+from .metrics import Metrics
+from .spool import DeadLetterSpool
 
 # list of kafka "errors" that are not really errors
 KAFKA_IGNORED_ERRS = [
@@ -14,6 +22,15 @@ KAFKA_IGNORED_ERRS = [
     confluent_kafka.KafkaError._TIMED_OUT,
 ]
 
+# dead-letter target for alerts that could not be annotated
+DEAD_LETTER_ANNOTATE = '_annotate'
+
+
+def configure_logging(config):
+    logging.basicConfig(level=config.get('logging', 'info'),
+                        format='%(asctime)s|WATCHTOWER|%(levelname)s: %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
 
 class Consumer:
 
@@ -22,23 +39,122 @@ class Consumer:
 
         "alert_consumers": ["log"],
         "timer_consumers": ["log"],
+        "error_consumers": ["log"],
         "consumer_cfgs": {},
 
         "brokers": "localhost:9092",
         "topic": "watchtower",
 
+        # errors reported by the detector are read from error_topic (if set),
+        # and from messages on the alert topic whose level is error_level (set
+        # to null to decode everything on the alert topic as alerts)
+        "error_topic": None,
+        "error_level": "error",
+
         "timer_interval": 60,
 
+        # up to batch_size messages are consumed from kafka at once, waiting
+        # at most batch_timeout seconds for them to arrive
+        "batch_size": 1,
+        "batch_timeout": 10,
+
+        # alerts are annotated in batches before being dispatched to
+        # consumers. a batch is annotated once it holds annotate_batch_size
+        # alerts, or annotate_linger seconds after its first alert arrived
+        "annotate_batch_size": 1,
+        "annotate_linger": 0,
+
+        # decode violations only as they are accessed, parsing alerts larger
+        # than stream_threshold bytes incrementally (requires ijson)
+        "lazy_decode": False,
+        "stream_threshold": 1048576,
+
+        # expression => meta annotation cache, set to null to disable
+        "meta_cache": {},
+
+        # run each consumer plugin on its own thread, fed by a queue of at most
+        # dispatch_queue_size alert batches. kafka consumption is paused while
+        # any queue is full, and resumed once every queue is at most
+        # dispatch_resume_backlog full
+        "dispatch_workers": False,
+        "dispatch_queue_size": 16,
+        "dispatch_resume_backlog": 0.5,
+
+        # "sync" or "async". the asyncio runtime awaits AsyncAbstractConsumer
+        # plugins directly and runs the others in a thread pool
+        "runtime": "sync",
+
+        # kafka offsets are committed (after asking the consumers to flush)
+        # every commit_interval seconds, or once commit_count messages have
+        # been consumed since the last commit. messages that were consumed
+        # but not committed are redelivered after a crash
+        "commit_interval": 10,
+        "commit_count": 5000,
+
+        # pipeline counters and latency histograms, see Metrics
+        "metrics": {},
+
+        # exact duplicate alerts (e.g., redelivered by kafka) are dropped before
+        # annotation, see DedupIndex. set to null to disable
+        "dedup": {},
+        # level of each (alert, violation) entity, used to hand plugins with
+        # state_changes_only set only the violations that changed state. set
+        # to null to hand them every alert
+        "state_changes": {},
+
+        # alerts that a plugin (or annotation) fails to handle are spooled to
+        # disk and retried in the background, see DeadLetterSpool. set to null
+        # to let such failures stop the consumer instead
+        "dead_letter": {},
+
         "consumers": {}
     }
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, worker_id=0, num_workers=1, stats_queue=None):
         self.config_file = os.path.expanduser(config_file)
         self.config = dict(self.defaults)
         self._load_config()
         self.topic = self.config['topic']
 
+        # set when running as one of several worker processes (see Supervisor)
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.stats_queue = stats_queue
+        self.metrics = Metrics(self.config['metrics'])
+        self.stats = self.metrics.counters
+        self.stats.update({
+            'messages': 0,
+            'alerts': 0,
+            'errors': 0,
+            'duplicates': 0,
+            'decode_errors': 0,
+            'kafka_errors': 0,
+        })
+
         self.next_timer = None
+        # set by stop, checked once per poll loop
+        self.stopping = False
+
+        self.pending_alerts = []
+        self.pending_since = None
+        # errors are dispatched along with the next batch of alerts
+        self.pending_errors = []
+        # {(topic, partition): offset} of messages not yet dispatched
+        self.pending_offsets = {}
+
+        if self.config['meta_cache'] is not None:
+            cache_cfg = dict(self.config['meta_cache'])
+            cache_cfg['path'] = shard_path(cache_cfg.get('path'), worker_id,
+                                           num_workers)
+            Alert.meta_cache = MetaCache(cache_cfg)
+
+        self.spool = None
+        if self.config['dead_letter'] is not None:
+            spool_cfg = dict(self.config['dead_letter'])
+            spool_cfg['path'] = shard_path(
+                spool_cfg.get('path', DeadLetterSpool.defaults['path']),
+                worker_id, num_workers)
+            self.spool = DeadLetterSpool(spool_cfg)
 
         self.consumer_instances = None
         self._init_plugins()
@@ -46,30 +162,93 @@ class Consumer:
         self.consumers = None
         self._init_consumers()
 
-        # connect to kafka
+        self.dedup = None
+        if self.config['dedup'] is not None:
+            self.dedup = DedupIndex(self.config['dedup'])
+        self.state_tracker = None
+        if self.config['state_changes'] is not None and \
+                any(c.state_changes_only for c in self.consumers['alert']):
+            self.state_tracker = StateTracker(self.config['state_changes'])
+
+        # don't decode violation history if nobody is going to look at it
+        self.skip_history = not any(c.needs_history
+                                    for c in self.consumers['alert'])
+        # nor ask Charthouse for meta annotations
+        self.annotate = any(c.needs_meta for c in self.consumers['alert'])
+        Alert.stream_threshold = self.config['stream_threshold']
+
+        self.workers = None
+        # offsets of dispatched batches, committed at consumer flushes
+        self.tracker = OffsetTracker()
+        self.uncommitted = 0
+        self.last_commit = time.time()
+        # names of consumers whose last flush was held back
+        self.flush_waiting = set()
+        self.paused = False
+        if self.config['dispatch_workers']:
+            if self.config['runtime'] == 'async':
+                logging.warning("dispatch_workers is not used by the async runtime")
+            else:
+                self._init_workers()
+
+        # set up by the async runtime
+        self.session = None
+        self.consumer_locks = None
+        self.executors = None
+
+        self.kc = None
+        self._init_kafka()
+
+    def _init_kafka(self):
         kafka_conf = {
             'bootstrap.servers': self.config['brokers'],
             'group.id': self.config['consumer_group'],
             'default.topic.config': {'auto.offset.reset': 'latest'},
             'heartbeat.interval.ms': 60000,
             'api.version.request': True,
+            # offsets are committed once every consumer has handled (and
+            # flushed) a message, see _maybe_commit
+            'enable.auto.commit': False,
         }
         self.kc = confluent_kafka.Consumer(**kafka_conf)
-        logging.info("Subscribing to alerts from '%s'" % self.topic)
-        self.kc.subscribe([self.topic])
+        topics = [self.topic]
+        if self.config['error_topic']:
+            topics.append(self.config['error_topic'])
+        logging.info("Subscribing to alerts from '%s'" % "', '".join(topics))
+        self.kc.subscribe(topics)
+
+    def _configured_plugins(self):
+        names = self.config['alert_consumers'] + self.config['timer_consumers'] + \
+            self.config['error_consumers']
+        return list(dict.fromkeys(names))
+
+    def _all_consumers(self):
+        # every started consumer instance, once
+        return list(dict.fromkeys(self.consumers['alert'] + self.consumers['timer'] +
+                                  self.consumers['error']))
+
+    def _flushed_consumers(self):
+        # consumers that must flush before offsets are committed
+        return list(dict.fromkeys(self.consumers['alert'] + self.consumers['error']))
 
     def _init_plugins(self):
-        consumers = {
-            "log": LogConsumer,
-            "database": DatabaseConsumer,
-            # "traceroute": watchtower.alert.consumers.TracerouteConsumer,
-            "timeseries": TimeseriesConsumer,
-            "slack": SlackConsumer,
-        }
+        # only the configured plugins are imported and instantiated (see
+        # watchtower.alert.consumers.load_consumer)
         self.consumer_instances = {}
-        for consumer, clz in list(consumers.items()):
+        # id(instance) => name, for metrics
+        self.consumer_names = {}
+        for consumer in self._configured_plugins():
+            clz = load_consumer(consumer)
+            if issubclass(clz, AsyncAbstractConsumer) and \
+                    self.config['runtime'] != 'async':
+                # its handlers would return coroutines that nobody awaits
+                raise ValueError("Consumer plugin '%s' requires the async "
+                                 "runtime (set \"runtime\": \"async\")" % consumer)
             cfg = self.config['consumers'].get(consumer, None)
             self.consumer_instances[consumer] = clz(cfg)
+            self.consumer_instances[consumer].set_worker(self.worker_id,
+                                                         self.num_workers)
+            self.consumer_names[id(self.consumer_instances[consumer])] = consumer
 
     def _load_config(self):
         with open(self.config_file) as fconfig:
@@ -78,13 +257,11 @@ class Consumer:
         # logging.debug(self.config)
 
     def _configure_logging(self):
-        logging.basicConfig(level=self.config.get('logging', 'info'),
-                            format='%(asctime)s|WATCHTOWER|%(levelname)s: %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S')
+        configure_logging(self.config)
 
     def _init_consumers(self):
         self.consumers = {}
-        for alert_type in ['alert', 'timer']:
+        for alert_type in ['alert', 'timer', 'error']:
             cfg = self.config[alert_type + '_consumers']
             self.consumers[alert_type] = []
             for cons_name in cfg:
@@ -92,24 +269,439 @@ class Consumer:
                 cons_inst.start()
                 self.consumers[alert_type].append(cons_inst)
 
+    def _init_workers(self):
+        self.workers = {}
+        for name, inst in self.consumer_instances.items():
+            # without a spool, _dead_letter raises and the worker gives up
+            # (see _check_workers)
+            worker = ConsumerWorker(
+                name, inst, self.config['dispatch_queue_size'],
+                metrics=self.metrics, on_failure=self._dead_letter,
+                divert=self._spool_behind)
+            worker.start()
+            self.workers[id(inst)] = worker
+
     def _handle_alert(self, msg):
-        logging.info("Handling alert: '%s'" % msg.value())
+        logging.debug("Handling alert: '%s'", msg.value())
+        start = time.perf_counter()
         try:
-            alert = Alert.from_json(msg.value())
+            if msg.topic() == self.config['error_topic']:
+                alert = Error.from_json(msg.value())
+            else:
+                alert = decode(msg.value(), lazy=self.config['lazy_decode'],
+                               skip_history=self.skip_history,
+                               error_level=self.config['error_level'])
         except (TypeError, ValueError) as e:
             logging.error("Could not extract Alert from json: %s" % msg.value())
             logging.exception(e)
+            self.stats['decode_errors'] += 1
+            return
+        finally:
+            self.metrics.observe('decode', time.perf_counter() - start)
+        alert.source = (msg.topic(), msg.partition(), msg.offset())
+        if isinstance(alert, Error):
+            self.stats['errors'] += 1
+            self.pending_errors.append(alert)
+            return
+        if self.dedup is not None and self.dedup.seen(alert):
+            logging.debug("Dropping duplicate alert %s at %d" % (alert.fqid, alert.time))
+            self.stats['duplicates'] += 1
+            return
+        self.stats['alerts'] += 1
+        if not self.pending_alerts:
+            self.pending_since = time.time()
+        self.pending_alerts.append(alert)
+
+    def _should_flush_alerts(self, now):
+        if not self.pending_alerts:
+            return False
+        return len(self.pending_alerts) >= self.config['annotate_batch_size'] or \
+            now - self.pending_since >= self.config['annotate_linger']
+
+    def _maybe_flush_alerts(self, now):
+        if not self.pending_alerts:
+            if self.pending_offsets:
+                # only errors (or nothing) to dispatch, but the offsets still
+                # need committing
+                self._dispatch_alerts([])
             return
+        if self._should_flush_alerts(now):
+            self._flush_alerts()
+
+    def _drop_malformed(self, alerts):
+        # lazily decoded alerts only find out that a violation is malformed
+        # once it is accessed, which must happen before annotation (or
+        # spooling) rather than in the middle of it
+        if not self.config['lazy_decode']:
+            return alerts
+        valid = []
+        for alert in alerts:
+            try:
+                if isinstance(alert.violations, LazyViolations):
+                    alert.violations.validate()
+            except TypeError as e:
+                logging.error("Could not extract violations of alert %s at %d: %s" %
+                              (alert.fqid, alert.time, e))
+                self.stats['alerts'] -= 1
+                self.stats['decode_errors'] += 1
+                continue
+            valid.append(alert)
+        return valid
+
+    def _flush_alerts(self):
+        alerts = self._drop_malformed(self.pending_alerts)
+        self.pending_alerts = []
+        self.pending_since = None
+        if not self.annotate:
+            pass
+        elif self.spool is not None and self.spool.failing(DEAD_LETTER_ANNOTATE):
+            # don't wait on Charthouse again while earlier alerts are still
+            # waiting for it to recover
+            self.spool.add(DEAD_LETTER_ANNOTATE, 'alerts',
+                           [alert.as_dict() for alert in alerts])
+            alerts = []
+        else:
+            # annotate every alert in the batch with a single meta lookup so
+            # that consumers are handed fully annotated alerts
+            try:
+                with self.metrics.timer('annotate'):
+                    Alert.annotate_many(alerts)
+            except Exception as e:
+                self._dead_letter(DEAD_LETTER_ANNOTATE, 'alerts', alerts, e)
+                alerts = []
+        self._dispatch_alerts(alerts)
+
+    def _dispatch_alerts(self, alerts):
+        offsets = self.pending_offsets
+        errors = self.pending_errors
+        self.pending_offsets = {}
+        self.pending_errors = []
+        # (consumer, kind, payload)
+        jobs = [(c, 'alerts', payload) for c, payload in self._alert_jobs(alerts)]
+        if errors:
+            jobs.extend((c, 'errors', errors) for c in self.consumers['error'])
+        if self.workers is None:
+            for consumer, kind, payload in jobs:
+                name = self.consumer_names[id(consumer)]
+                if self._spool_behind(name, kind, payload):
+                    continue
+                try:
+                    with self.metrics.timer(kind, name):
+                        getattr(consumer, 'handle_' + kind)(payload)
+                except Exception as e:
+                    self._dead_letter(name, kind, payload, e)
+            self.tracker.add(DispatchTicket(offsets, 0))
+            return
+        ticket = DispatchTicket(offsets, len(jobs))
+        self.tracker.add(ticket)
+        for consumer, kind, payload in jobs:
+            self.workers[id(consumer)].submit(kind, payload, ticket)
+
+    def _alert_jobs(self, alerts):
+        """(consumer, alerts) for each alert consumer, where consumers that
+        only want state changes are handed just those (if there are any)."""
+        if not alerts:
+            return []
+        changes = None
+        jobs = []
         for consumer in self.consumers['alert']:
-            consumer.handle_alert(alert)
+            payload = alerts
+            if self.state_tracker is not None and consumer.state_changes_only:
+                if changes is None:
+                    changes = self.state_tracker.changes(alerts)
+                payload = changes
+            if payload:
+                jobs.append((consumer, payload))
+        return jobs
+
+    def _spool_behind(self, target, kind, items):
+        """Spool alerts/errors for `target` if earlier ones are still waiting
+        to be retried, so that it is handed them in order. May be called from
+        worker threads.
+
+        :return: whether the items were spooled
+        """
+        if self.spool is None or not self.spool.failing(target):
+            return False
+        self.spool.add(target, kind, [item.as_dict() for item in items])
+        return True
+
+    def _dead_letter(self, target, kind, items, error):
+        """Spool alerts/errors that `target` failed to handle. Without a spool
+        the error is raised, and the messages are redelivered after a restart.
+        May be called from worker threads."""
+        if self.spool is None:
+            raise error
+        logging.error("'%s' failed to handle %d %s, spooling them for a retry: %r" %
+                      (target, len(items), kind, error))
+        self.spool.add(target, kind, [item.as_dict() for item in items], error)
+
+    def _load_dead_letters(self, batch):
+        clz = Error if batch.kind == 'errors' else Alert
+        return [clz.from_dict(item) for item in batch.items]
+
+    def _retry_dead_letters(self):
+        if self.spool is None:
+            return
+        batch = self.spool.next_retry()
+        while batch is not None:
+            self._retry_dead_letter(batch)
+            batch = self.spool.next_retry()
+
+    def _retry_dead_letter(self, batch):
+        try:
+            items = self._load_dead_letters(batch)
+        except (TypeError, ValueError) as e:
+            self.spool.retry_done(batch, e)
+            return
+        if batch.target == DEAD_LETTER_ANNOTATE:
+            try:
+                if self.annotate:
+                    with self.metrics.timer('annotate'):
+                        Alert.annotate_many(items)
+            except Exception as e:
+                self.spool.retry_done(batch, e)
+                return
+            self._retry_annotated(batch, items)
+            return
+        consumer = self.consumer_instances.get(batch.target)
+        if consumer is None:
+            self.spool.retry_done(batch, RuntimeError(
+                "Consumer '%s' is not configured" % batch.target))
+        elif self.workers is not None:
+            self.workers[id(consumer)].submit('call', functools.partial(
+                self._retry_consumer, consumer, batch, items))
+        else:
+            self._retry_consumer(consumer, batch, items)
+
+    def _retry_consumer(self, consumer, batch, items):
+        # the spool only moves past the items once the consumer has made them
+        # durable, their kafka offsets were committed long ago
+        try:
+            getattr(consumer, 'handle_' + batch.kind)(items)
+            consumer.flush()
+        except Exception as e:
+            self.spool.retry_done(batch, e)
+            return
+        self.spool.retry_done(batch)
+
+    def _retry_annotated(self, batch, items):
+        """Hand alerts that could be annotated on retry to the consumers. The
+        spool moves past them once every consumer has handled and flushed its
+        share (or spooled it for itself)."""
+        jobs = self._alert_jobs(items)
+        if not jobs:
+            self.spool.retry_done(batch)
+            return
+        if self.workers is None:
+            error = None
+            for consumer, payload in jobs:
+                try:
+                    self._deliver_retried(consumer, payload)
+                except Exception as e:
+                    error = e
+            self.spool.retry_done(batch, error)
+            return
+        ticket = DispatchTicket({}, len(jobs))
+        errors = []
+
+        def deliver(consumer, payload):
+            try:
+                self._deliver_retried(consumer, payload)
+            except Exception as e:
+                errors.append(e)
+            if ticket.ack():
+                self.spool.retry_done(batch, errors[0] if errors else None)
+
+        for consumer, payload in jobs:
+            self.workers[id(consumer)].submit('call', functools.partial(
+                deliver, consumer, payload))
+
+    def _deliver_retried(self, consumer, alerts):
+        try:
+            consumer.handle_alerts(alerts)
+        except Exception as e:
+            self._dead_letter(self.consumer_names[id(consumer)], 'alerts',
+                              alerts, e)
+        consumer.flush()
+
+    def _commit_due(self, now):
+        return self.uncommitted >= self.config['commit_count'] or \
+            (self.uncommitted and
+             now - self.last_commit >= self.config['commit_interval'])
+
+    def _flush_failed(self, consumer, error):
+        logging.error("Consumer '%s' failed to flush, not committing offsets: %r" %
+                      (self.consumer_names[id(consumer)], error))
+        # try again at the next commit interval
+        self.uncommitted = max(self.uncommitted, 1)
+
+    def _flush_waiting(self, consumer, ready):
+        """Track consumers that held a flush back (see AbstractConsumer.flush),
+        logging once each time one starts doing so."""
+        name = self.consumer_names[id(consumer)]
+        if ready:
+            self.flush_waiting.discard(name)
+            return
+        if name not in self.flush_waiting:
+            logging.info("Waiting for consumer '%s' before committing offsets" %
+                         name)
+            self.flush_waiting.add(name)
+        # try again at the next commit interval
+        self.uncommitted = max(self.uncommitted, 1)
+
+    def _maybe_commit(self, now):
+        if self._commit_due(now):
+            self.uncommitted = 0
+            self.last_commit = now
+            consumers = self._flushed_consumers()
+            if self.workers is None:
+                flushed = True
+                for consumer in consumers:
+                    try:
+                        with self.metrics.timer('flush',
+                                                self.consumer_names[id(consumer)]):
+                            ready = consumer.flush() is not False
+                    except Exception as e:
+                        self._flush_failed(consumer, e)
+                        flushed = False
+                        continue
+                    self._flush_waiting(consumer, ready)
+                    flushed = flushed and ready
+                # offsets are only committed up to a flush that succeeded
+                if flushed:
+                    self.tracker.add(DispatchTicket({}, 0, barrier=True))
+            else:
+                # the offsets are committed once every worker has flushed
+                ticket = DispatchTicket({}, len(consumers), barrier=True)
+                self.tracker.add(ticket)
+                for consumer in consumers:
+                    self.workers[id(consumer)].submit('flush', None, ticket)
+        if self.tracker.barriers:
+            self._commit_offsets()
+            if self.workers is not None and self.tracker.held_back():
+                # flush again at the next commit interval
+                self.uncommitted = max(self.uncommitted, 1)
+
+    def _commit_offsets(self, asynchronous=True):
+        offsets = self.tracker.pop_done()
+        if not offsets:
+            return
+        if self.spool is not None:
+            # whatever was spooled instead of handled must survive a crash
+            self.spool.flush()
+        tps = [confluent_kafka.TopicPartition(topic, partition, offset + 1)
+               for (topic, partition), offset in offsets.items()]
+        try:
+            with self.metrics.timer('commit'):
+                self.kc.commit(offsets=tps, asynchronous=asynchronous)
+        except confluent_kafka.KafkaException as e:
+            logging.error("Failed to commit offsets: %s" % e)
+
+    def _check_workers(self):
+        # a worker that gave up on a batch stops the consumer, as a failure
+        # would without workers
+        for worker in self.workers.values():
+            if worker.error is not None:
+                raise worker.error
+
+    def _apply_backpressure(self):
+        workers = self.workers.values()
+        if not self.paused and any(w.full for w in workers):
+            logging.warning("Consumer queue full, pausing Kafka consumption")
+            self.kc.pause(self.kc.assignment())
+            self.paused = True
+        elif self.paused and all(w.backlog() <= self.config['dispatch_resume_backlog']
+                                 for w in workers):
+            logging.info("Consumer queues drained, resuming Kafka consumption")
+            self.kc.resume(self.kc.assignment())
+            self.paused = False
 
     def _handle_timer(self, now):
+        if Alert.meta_cache is not None:
+            Alert.meta_cache.prune()
+            logging.info("Meta cache: %(size)d entries, %(hits)d hits, "
+                         "%(misses)d misses" % Alert.meta_cache.stats())
+        self._report_stats()
         for consumer in self.consumers['timer']:
-            consumer.handle_timer(now)
+            if self.workers is not None:
+                self.workers[id(consumer)].submit('timer', now)
+            else:
+                with self.metrics.timer('timer', self.consumer_names[id(consumer)]):
+                    consumer.handle_timer(now)
+
+    def _report_stats(self):
+        if self.spool is not None:
+            spool_stats = self.spool.stats()
+            self.stats['dead_letters'] = spool_stats['spooled']
+            if spool_stats['spooled'] or spool_stats['backlog']:
+                logging.info("Dead letters: %(spooled)d spooled, %(retried)d "
+                             "retried, %(quarantined)d quarantined, backlog "
+                             "for %(backlog)s" % spool_stats)
+        if self.metrics.config['log']:
+            self.metrics.log_summary()
+        if self.stats_queue is None:
+            return
+        stats = dict(self.stats)
+        if Alert.meta_cache is not None:
+            cache_stats = Alert.meta_cache.stats()
+            stats['meta_cache_hits'] = cache_stats['hits']
+            stats['meta_cache_misses'] = cache_stats['misses']
+        self.stats_queue.put((self.worker_id, stats))
+
+    def _stop_consumer(self, consumer):
+        try:
+            consumer.stop()
+        except Exception as e:
+            logging.error("Consumer '%s' failed to stop" %
+                          self.consumer_names[id(consumer)])
+            logging.exception(e)
+            return False
+        return True
+
+    def _stopped(self, stopped):
+        # consumers flush everything they hold when stopped
+        if not all(stopped):
+            logging.error("Not committing the final offsets, the messages "
+                          "since the last commit will be redelivered")
+            return
+        self.tracker.add(DispatchTicket({}, 0, barrier=True))
+        self._commit_offsets(asynchronous=False)
+
+    def _stop_consumers(self):
+        if self.workers is not None:
+            # workers stop their consumer once their queue has drained
+            stopped = [worker.stop() for worker in self.workers.values()]
+        else:
+            stopped = [self._stop_consumer(c) for c in self._all_consumers()]
+        self._stopped(stopped)
 
     def run(self):
-        # loop forever consuming alerts
-        while True:
+        self.metrics.start(self.worker_id)
+        if self.spool is not None:
+            self.spool.start()
+        try:
+            if self.config['runtime'] == 'async':
+                asyncio.run(self._run_async())
+                return
+            try:
+                self._run()
+            finally:
+                self._stop_consumers()
+        finally:
+            if self.spool is not None:
+                self.spool.stop()
+            self.metrics.stop()
+
+    def stop(self):
+        """Ask the consumer to stop after the current poll loop, going through
+        the normal shutdown (flushing and stopping the plugins). Safe to call
+        from a signal handler."""
+        self.stopping = True
+
+    def _run(self):
+        # loop until stopped, consuming alerts
+        while not self.stopping:
             # TIMERS
             now = time.time()
             if not self.next_timer or now >= self.next_timer:
@@ -121,16 +713,246 @@ class Consumer:
                     self.next_timer = (int(now/interval) * interval) + interval
 
             # ALERTS
-            msg = self.kc.poll(10)
-            if msg is None:
-                continue
-            if not msg.error():
+            timeout = self._consume_timeout(now)
+            if self.paused:
+                # don't wait long, we need to check if the workers caught up
+                timeout = min(timeout, 1)
+            with self.metrics.timer('kafka_poll'):
+                msgs = self.kc.consume(num_messages=self.config['batch_size'],
+                                       timeout=timeout)
+            self.metrics.profiler.tick(len(msgs))
+            if not self._handle_msgs(msgs):
+                break
+            now = time.time()
+            self._maybe_flush_alerts(now)
+            self._maybe_commit(now)
+            self._retry_dead_letters()
+
+            if self.workers is not None:
+                self._check_workers()
+                self._apply_backpressure()
+
+    def _consume_timeout(self, now):
+        timeout = self.config['batch_timeout']
+        if self.pending_alerts:
+            linger_end = self.pending_since + self.config['annotate_linger']
+            timeout = max(0, min(timeout, linger_end - now))
+        return timeout
+
+    async def _run_async(self):
+        # only needed by the async runtime, keeps it out of sync startup
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        self.session = aiohttp.ClientSession()
+        # a consumer is never handed alerts and timers concurrently
+        self.consumer_locks = {id(c): asyncio.Lock()
+                               for c in self._all_consumers()}
+        # synchronous consumers each get a thread of their own, since they
+        # may hold objects that can't be used from another thread (e.g., a
+        # sqlite connection)
+        self.executors = {
+            id(c): concurrent.futures.ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix='consumer-%s' % self.consumer_names[id(c)])
+            for c in self._all_consumers()
+            if not isinstance(c, AsyncAbstractConsumer)}
+        timer_task = asyncio.ensure_future(self._timer_loop())
+        try:
+            while not self.stopping:
+                consume = functools.partial(
+                    self.kc.consume, num_messages=self.config['batch_size'],
+                    timeout=self._consume_timeout(time.time()))
+                with self.metrics.timer('kafka_poll'):
+                    msgs = await loop.run_in_executor(None, consume)
+                self.metrics.profiler.tick(len(msgs))
+                if not self._handle_msgs(msgs):
+                    break
+                now = time.time()
+                if self._should_flush_alerts(now) or \
+                        (not self.pending_alerts and self.pending_offsets):
+                    await self._flush_alerts_async()
+                await self._maybe_commit_async(now)
+                await self._retry_dead_letters_async()
+        finally:
+            timer_task.cancel()
+            await self._stop_consumers_async()
+            await self.session.close()
+
+    async def _timer_loop(self):
+        interval = self.config['timer_interval']
+        while True:
+            now = time.time()
+            await asyncio.sleep((int(now / interval) * interval) + interval - now)
+            try:
+                await self._handle_timer_async(time.time())
+            except Exception as e:
+                # keep the timers going
+                logging.error("Timer handling failed")
+                logging.exception(e)
+
+    async def _call_consumer(self, consumer, method, *args):
+        stage = method.replace('handle_', '')
+        async with self.consumer_locks[id(consumer)]:
+            with self.metrics.timer(stage, self.consumer_names[id(consumer)]):
+                if isinstance(consumer, AsyncAbstractConsumer):
+                    return await getattr(consumer, method)(*args)
+                # profiled there, cProfile only covers the thread enabling it
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.executors[id(consumer)],
+                    functools.partial(self.metrics.profiler.call,
+                                      getattr(consumer, method), *args))
+
+    async def _flush_alerts_async(self):
+        alerts = self._drop_malformed(self.pending_alerts)
+        errors = self.pending_errors
+        offsets = self.pending_offsets
+        self.pending_alerts = []
+        self.pending_errors = []
+        self.pending_since = None
+        self.pending_offsets = {}
+        if alerts and self.annotate and self.spool is not None and \
+                self.spool.failing(DEAD_LETTER_ANNOTATE):
+            self.spool.add(DEAD_LETTER_ANNOTATE, 'alerts',
+                           [alert.as_dict() for alert in alerts])
+            alerts = []
+        if alerts and self.annotate:
+            try:
+                with self.metrics.timer('annotate'):
+                    await Alert.annotate_many_async(alerts, self.session)
+            except Exception as e:
+                self._dead_letter(DEAD_LETTER_ANNOTATE, 'alerts', alerts, e)
+                alerts = []
+        if alerts:
+            await asyncio.gather(*[self._dispatch_async(c, 'alerts', payload)
+                                   for c, payload in self._alert_jobs(alerts)])
+        if errors:
+            await asyncio.gather(*[self._dispatch_async(c, 'errors', errors)
+                                   for c in self.consumers['error']])
+        self.tracker.add(DispatchTicket(offsets, 0))
+
+    async def _dispatch_async(self, consumer, kind, items):
+        if self._spool_behind(self.consumer_names[id(consumer)], kind, items):
+            return
+        try:
+            await self._call_consumer(consumer, 'handle_' + kind, items)
+        except Exception as e:
+            self._dead_letter(self.consumer_names[id(consumer)], kind, items, e)
+
+    async def _retry_dead_letters_async(self):
+        if self.spool is None:
+            return
+        batch = self.spool.next_retry()
+        while batch is not None:
+            # the spool only moves past a batch once it has been handled and
+            # flushed (see _retry_consumer)
+            try:
+                items = self._load_dead_letters(batch)
+                if batch.target == DEAD_LETTER_ANNOTATE:
+                    if self.annotate:
+                        await Alert.annotate_many_async(items, self.session)
+                    await self._retry_annotated_async(items)
+                else:
+                    consumer = self.consumer_instances.get(batch.target)
+                    if consumer is None:
+                        raise RuntimeError("Consumer '%s' is not configured" %
+                                           batch.target)
+                    await self._call_consumer(consumer, 'handle_' + batch.kind,
+                                              items)
+                    await self._call_consumer(consumer, 'flush')
+            except Exception as e:
+                self.spool.retry_done(batch, e)
+            else:
+                self.spool.retry_done(batch)
+            batch = self.spool.next_retry()
+
+    async def _retry_annotated_async(self, items):
+        jobs = self._alert_jobs(items)
+        await asyncio.gather(*[self._dispatch_async(c, 'alerts', payload)
+                               for c, payload in jobs])
+        results = await asyncio.gather(*[self._call_consumer(c, 'flush')
+                                         for c, _ in jobs],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def _maybe_commit_async(self, now):
+        if not self._commit_due(now):
+            return
+        self.uncommitted = 0
+        self.last_commit = now
+        consumers = self._flushed_consumers()
+        results = await asyncio.gather(*[self._call_consumer(c, 'flush')
+                                         for c in consumers],
+                                       return_exceptions=True)
+        flushed = True
+        for consumer, result in zip(consumers, results):
+            if isinstance(result, Exception):
+                self._flush_failed(consumer, result)
+                flushed = False
+            else:
+                self._flush_waiting(consumer, result is not False)
+                flushed = flushed and result is not False
+        if flushed:
+            self.tracker.add(DispatchTicket({}, 0, barrier=True))
+        self._commit_offsets()
+
+    async def _handle_timer_async(self, now):
+        if Alert.meta_cache is not None:
+            Alert.meta_cache.prune()
+            logging.info("Meta cache: %(size)d entries, %(hits)d hits, "
+                         "%(misses)d misses" % Alert.meta_cache.stats())
+        self._report_stats()
+        consumers = self.consumers['timer']
+        results = await asyncio.gather(*[self._call_consumer(c, 'handle_timer', now)
+                                         for c in consumers],
+                                       return_exceptions=True)
+        for consumer, result in zip(consumers, results):
+            if isinstance(result, Exception):
+                logging.error("Consumer '%s' failed to handle timer" %
+                              self.consumer_names[id(consumer)], exc_info=result)
+
+    async def _stop_consumers_async(self):
+        loop = asyncio.get_running_loop()
+        stopped = []
+        for consumer in self._all_consumers():
+            if isinstance(consumer, AsyncAbstractConsumer):
+                stop = consumer.stop()
+            else:
+                stop = loop.run_in_executor(
+                    self.executors[id(consumer)],
+                    functools.partial(self._stop_consumer, consumer))
+            try:
+                stopped.append(await stop is not False)
+            except Exception as e:
+                logging.error("Consumer '%s' failed to stop" %
+                              self.consumer_names[id(consumer)])
+                logging.exception(e)
+                stopped.append(False)
+        for executor in self.executors.values():
+            executor.shutdown()
+        self._stopped(stopped)
+
+    def _handle_msgs(self, msgs):
+        for msg in msgs:
+            err = msg.error()
+            if not err:
+                self.stats['messages'] += 1
+                self.uncommitted += 1
+                self.pending_offsets[(msg.topic(), msg.partition())] = msg.offset()
                 self._handle_alert(msg)
-            elif msg.error().code() in KAFKA_IGNORED_ERRS:
-                logging.debug("Ignoring benign kafka 'error': %s" % msg.error().code())
+            elif err.code() in KAFKA_IGNORED_ERRS:
+                logging.debug("Ignoring benign kafka 'error': %s" % err.code())
+            elif err.fatal():
+                logging.error("Fatal Kafka error: %s" % err)
+                self.stats['kafka_errors'] += 1
+                return False
             else:
-                logging.error("Unhandled Kafka error: %s" % msg.error())
-                break
+                # librdkafka recovers from everything else (broker down,
+                # rebalances, ...) on its own
+                logging.warning("Kafka error: %s" % err)
+                self.stats['kafka_errors'] += 1
+        return True
 
 
 def main():
@@ -141,8 +963,17 @@ def main():
     parser.add_argument('-c',  '--config-file',
                         nargs='?', required=True,
                         help='Config file')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of consumer processes to run (each is '
+                             'assigned a share of the topic partitions)')
 
     opts = vars(parser.parse_args())
+    workers = opts.pop('workers')
+
+    if workers > 1:
+        from .supervisor import Supervisor
+        Supervisor(opts['config_file'], workers).run()
+        return
 
     server = Consumer(**opts)
     server.run()
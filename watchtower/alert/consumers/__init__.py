@@ -1,31 +1,172 @@
 import abc
+import importlib
+import importlib.metadata
+import os
+
+# third-party plugins register their AbstractConsumer subclass under this
+# entry point group, with the name used in alert_consumers/timer_consumers
+ENTRY_POINT_GROUP = 'watchtower.alert.consumers'
+
+# plugins that ship with watchtower-alert. these are also registered as entry
+# points, but are looked up here first so that startup doesn't need to scan the
+# installed distributions (and so that they work from a source checkout)
+BUILTIN_CONSUMERS = {
+    'log': 'watchtower.alert.consumers.log:LogConsumer',
+    'database': 'watchtower.alert.consumers.database:DatabaseConsumer',
+    'timeseries': 'watchtower.alert.consumers.timeseries:TimeseriesConsumer',
+    'slack': 'watchtower.alert.consumers.slack:SlackConsumer',
+    'slack-async': 'watchtower.alert.consumers.slack:AsyncSlackConsumer',
+}
+
+
+def _import_attr(path):
+    module, _, attr = path.partition(':')
+    return getattr(importlib.import_module(module), attr)
+
+
+def _entry_points():
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=ENTRY_POINT_GROUP)
+    return eps.get(ENTRY_POINT_GROUP, [])
+
+
+def load_consumer(name):
+    """Import the consumer plugin class registered as `name`. Only the
+    plugin's own module (and so its dependencies) is imported."""
+    if name in BUILTIN_CONSUMERS:
+        return _import_attr(BUILTIN_CONSUMERS[name])
+    for ep in _entry_points():
+        if ep.name == name:
+            return ep.load()
+    raise ValueError("Unknown consumer plugin '%s'" % name)
+
+
+def __getattr__(name):
+    # keeps `from watchtower.alert.consumers import DatabaseConsumer` working
+    # without importing every plugin up front
+    for path in BUILTIN_CONSUMERS.values():
+        if path.endswith(':' + name):
+            return _import_attr(path)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
+def shard_path(path, worker_id, num_workers):
+    """Make a file path unique to a worker process when running several
+    workers: "{worker_id}" in the path is replaced with the worker id, and
+    paths without it get the id added before their extension."""
+    if not path or num_workers <= 1:
+        return path
+    if '{worker_id}' in path:
+        return path.replace('{worker_id}', str(worker_id))
+    root, ext = os.path.splitext(path)
+    return "%s.%d%s" % (root, worker_id, ext)
 
 
 class AbstractConsumer(metaclass=abc.ABCMeta):
+    """Base class for consumer plugins.
+
+    When watchtower-alert runs with several worker processes (--workers),
+    every worker has its own instance of each plugin, and each worker is
+    handed the alerts of a disjoint set of kafka partitions. Plugins must
+    therefore not share local state between processes (use shard_path for
+    files), and plugins that aggregate alerts per name/fqid rely on the
+    producer sending all alerts with the same name to the same partition.
+    """
+
+    # whether this consumer reads Violation.history. when no configured
+    # consumer does, the Consumer skips decoding it
+    needs_history = True
+
+    # whether this consumer reads Violation.meta. when no configured consumer
+    # does, alerts are not annotated (see Alert.annotate_many)
+    needs_meta = True
+
+    # whether this consumer should only be handed the violations whose level
+    # changed (see watchtower.alert.dedup.StateTracker), e.g., to notify
+    state_changes_only = False
+
     def __init__(self, config):
         self.config = config
+        self.worker_id = 0
+        self.num_workers = 1
+
+    def set_worker(self, worker_id, num_workers):
+        # called before start
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+
+    def shard_path(self, path):
+        return shard_path(path, self.worker_id, self.num_workers)
 
     def start(self):
         pass
 
+    def stop(self):
+        pass
+
     @abc.abstractmethod
     def handle_alert(self, alert):
+        # alerts are annotated (see Alert.annotate_many) before being
+        # dispatched to consumers, if any consumer needs_meta
+        pass
+
+    def handle_alerts(self, alerts):
+        # consumers that can process a whole batch of alerts more efficiently
+        # should override this
+        for alert in alerts:
+            self.handle_alert(alert)
+
+    def flush(self):
+        # called before kafka offsets are committed. consumers that buffer
+        # alerts must make everything they were handed so far durable here,
+        # and should handle seeing the same alert again after a restart.
+        # consumers that can't do so yet (e.g., messages still being sent)
+        # return False to hold the commit back until a later flush; raise
+        # only on errors
         pass
 
     @abc.abstractmethod
     def handle_error(self, error):
         pass
 
+    def handle_errors(self, errors):
+        # see handle_alerts
+        for error in errors:
+            self.handle_error(error)
+
     @abc.abstractmethod
     def handle_timer(self, now):
         pass
 
-# When adding a consumer here, also add to _init_plugins method in
-# watchtower.alert.consumer.py
-# TODO: make adding consumer more dynamic
-from .log import LogConsumer
-# from watchtower.alert.consumers.email import EmailConsumer
-from .database import DatabaseConsumer
-# from watchtower.alert.consumers.traceroute import TracerouteConsumer
-from .timeseries import TimeseriesConsumer
-from .slack import SlackConsumer
\ No newline at end of file
+
+class AsyncAbstractConsumer(AbstractConsumer):
+    """Consumer whose handlers are coroutines. These are awaited directly
+    when the Consumer uses the asyncio runtime (synchronous consumers are run
+    in a thread pool instead)."""
+
+    async def stop(self):
+        pass
+
+    @abc.abstractmethod
+    async def handle_alert(self, alert):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def handle_alerts(self, alerts):
+        for alert in alerts:
+            await self.handle_alert(alert)
+
+    @abc.abstractmethod
+    async def handle_error(self, error):
+        pass
+
+    async def handle_errors(self, errors):
+        for error in errors:
+            await self.handle_error(error)
+
+    @abc.abstractmethod
+    async def handle_timer(self, now):
+        pass
@@ -1,12 +1,160 @@
+import calendar
+import io
 import logging
+import re
 import sqlalchemy
+import sqlalchemy.dialects.postgresql
 import sqlalchemy.engine.url
+import time
 
 from . import AbstractConsumer
 
 
+def table_name(config, table):
+    suffix = config['%s_table_name' % table]
+    return "%s_%s" % (config['table_prefix'], suffix) \
+        if config['table_prefix'] else suffix
+
+
+def engine_url(config, host=None):
+    engine_options = [config[n] for n in (
+        'drivername', 'username', 'password', 'host', 'port',
+        'databasename')]
+    if host is not None:
+        engine_options[3] = host
+    if 'sqlite' in engine_options[0] and engine_options[3]:
+        engine_options[3] = '/' + engine_options[3]
+    return str(sqlalchemy.engine.url.URL(*engine_options))
+
+
+def partition_name(table, month):
+    return "%s_p%04d%02d" % (table, month[0], month[1])
+
+
+def _month(ts):
+    return tuple(time.gmtime(ts)[:2])
+
+
+def _add_months(month, n):
+    i = month[0] * 12 + month[1] - 1 + n
+    return i // 12, i % 12 + 1
+
+
+def _month_start(month):
+    return calendar.timegm((month[0], month[1], 1, 0, 0, 0))
+
+
+def alert_table(meta, name, partitioned=False):
+    """Define an alert table (or a partition of one, for sqlite).
+
+    :param partitioned: make it a postgresql table partitioned by time range
+    """
+    if partitioned:
+        # a partitioned table can only have unique constraints that include the
+        # partition key, and time may be null, so id is just a sequence value
+        seq = sqlalchemy.Sequence('watchtower_alert_id_seq', metadata=meta)
+        id_column = sqlalchemy.Column(
+            'id', sqlalchemy.Integer, nullable=False,
+            server_default=sqlalchemy.text("nextval('%s')" % seq.name))
+        kwargs = {'postgresql_partition_by': 'RANGE (time)'}
+    else:
+        id_column = sqlalchemy.Column(
+            'id', sqlalchemy.Integer,
+            sqlalchemy.Sequence('watchtower_alert_id_seq'), primary_key=True)
+        kwargs = {}
+
+    return sqlalchemy.Table(
+        name,
+        meta,
+
+        # Alert columns
+        id_column,
+        sqlalchemy.Column('fqid', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('name', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('query_time', sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column('level', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('method', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('query_expression', sqlalchemy.Text, nullable=False),
+        sqlalchemy.Column('history_query_expression', sqlalchemy.Text,
+                          nullable=False),
+
+        # Violation columns, some of which could be null when no data, back to normal, etc
+        sqlalchemy.Column('time', sqlalchemy.Integer),
+        sqlalchemy.Column('expression', sqlalchemy.Text),
+        sqlalchemy.Column('condition', sqlalchemy.String),
+        sqlalchemy.Column('value', sqlalchemy.Float),
+        sqlalchemy.Column('history_value', sqlalchemy.Float),
+
+        # Metadata columns, which some violations do not have
+        sqlalchemy.Column('meta_type', sqlalchemy.String),
+        sqlalchemy.Column('meta_code', sqlalchemy.String),
+
+        sqlalchemy.UniqueConstraint('fqid', 'time', 'level', 'expression'),
+        sqlalchemy.Index(name + '_type_idx', 'meta_type'),
+        sqlalchemy.Index(name + '_type_code_idx', 'meta_type', 'meta_code'),
+        # entity and series history over a time range (see watchtower.alert.query)
+        sqlalchemy.Index(name + '_type_code_time_idx',
+                         'meta_type', 'meta_code', 'time'),
+        sqlalchemy.Index(name + '_fqid_time_idx', 'fqid', 'time'),
+        **kwargs
+    )
+
+
+def define_tables(meta, config):
+    """Define the tables used by DatabaseConsumer (and read by
+    watchtower.alert.query).
+
+    :param config: DatabaseConsumer config
+    :return: dict of 'alert', 'error' and 'state' => sqlalchemy.Table
+    """
+    # with sqlite partitioning, the alert "table" is a view over the
+    # per-month tables
+    t_alert = alert_table(meta, table_name(config, 'alert'),
+                          partitioned=config.get('partitioning') is not None and
+                          'postgresql' in config['drivername'])
+
+    t_error = sqlalchemy.Table(
+        table_name(config, 'error'),
+        meta,
+        sqlalchemy.Column('id', sqlalchemy.Integer,
+                          sqlalchemy.Sequence('watchtower_error_id_seq'),
+                          primary_key=True),
+        sqlalchemy.Column('fqid', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('name', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('query_time', sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column('query_expression', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('history_query_expression', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('type', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('message', sqlalchemy.String, nullable=False),
+        sqlalchemy.UniqueConstraint('fqid', 'query_time', 'query_expression', 'type',
+                                    'message')
+    )
+
+    # latest violation of every (fqid, expression) series
+    t_state_name = table_name(config, 'state')
+    t_state = sqlalchemy.Table(
+        t_state_name,
+        meta,
+        sqlalchemy.Column('fqid', sqlalchemy.String, primary_key=True),
+        sqlalchemy.Column('expression', sqlalchemy.Text, primary_key=True),
+        sqlalchemy.Column('name', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('level', sqlalchemy.String, nullable=False),
+        sqlalchemy.Column('time', sqlalchemy.Integer, nullable=False),
+        sqlalchemy.Column('value', sqlalchemy.Float),
+        sqlalchemy.Column('history_value', sqlalchemy.Float),
+        sqlalchemy.Column('meta_type', sqlalchemy.String),
+        sqlalchemy.Column('meta_code', sqlalchemy.String),
+        sqlalchemy.Index(t_state_name + '_type_code_idx', 'meta_type', 'meta_code'),
+        sqlalchemy.Index(t_state_name + '_level_idx', 'level'),
+    )
+
+    return {'alert': t_alert, 'error': t_error, 'state': t_state}
+
+
 class DatabaseConsumer(AbstractConsumer):
 
+    needs_history = False
+
     defaults = {
         'drivername': 'sqlite',
         'username': None,
@@ -18,142 +166,494 @@ class DatabaseConsumer(AbstractConsumer):
         'table_prefix': 'watchtower',
         'alert_table_name': 'alert',
         'error_table_name': 'error',
+        # violation (and error) rows are buffered and written in a single
+        # statement once flush_rows rows are buffered or flush_interval seconds
+        # have passed (add this consumer to timer_consumers so that quiet
+        # periods flush)
+        'flush_rows': 1000,
+        'flush_interval': 10,
+        # 'insert' or 'copy'. copy (postgresql only) streams buffered rows into
+        # a staging table using COPY and then merges them into the alert table
+        'insert_mode': 'insert',
+        # maintain a table holding the latest level of every (fqid,
+        # expression) series, for cheap "current state" queries (postgresql
+        # and sqlite only)
+        'maintain_state': False,
+        'state_table_name': 'alert_state',
+        # partition the alert table by violation time, one partition per
+        # month, so that old alerts can be dropped a month at a time (see
+        # partitioning_defaults), None to disable. postgresql (>= 11) uses
+        # declarative partitioning, sqlite a table per month behind a view
+        'partitioning': None,
+    }
+
+    partitioning_defaults = {
+        # months of partitions to create ahead of the current one
+        'ahead': 2,
+        # drop partitions that ended more than this many months ago, None to
+        # keep everything
+        'retention_months': None,
     }
 
+    # how often (in seconds) handle_timer creates/drops partitions
+    PARTITION_CHECK_INTERVAL = 3600
+
+    # columns of the state table that are updated from each violation
+    STATE_COLUMNS = ('name', 'level', 'time', 'value', 'history_value',
+                     'meta_type', 'meta_code')
+
     def __init__(self, config):
-        super(DatabaseConsumer, self).__init__(self.defaults)
+        super(DatabaseConsumer, self).__init__(dict(self.defaults))
         if config:
             self.config.update(config)
+        self.conn = None
+        self.alert_rows = []
+        self.error_rows = []
+        self.last_flush = time.time()
+
+        self.partitioning = None
+        if self.config['partitioning'] is not None:
+            self.partitioning = dict(self.partitioning_defaults)
+            self.partitioning.update(self.config['partitioning'])
+        # sqlite partition tables, (year, month) (or None for the default
+        # partition) => sqlalchemy.Table
+        self.partitions = {}
+        self.partition_meta = sqlalchemy.MetaData()
+        self.next_partition_check = 0
 
     def start(self):
         self._init_db()
 
     def _init_db(self):
         meta = sqlalchemy.MetaData()
+        tables = define_tables(meta, self.config)
+        self.t_alert = tables['alert']
+        self.t_error = tables['error']
+        self.t_state = tables['state'] if self.config['maintain_state'] else None
 
-        t_alert_name = self._table_name('alert')
-        self.t_alert = sqlalchemy.Table(
-            t_alert_name,
-            meta,
-
-            # Alert columns
-            sqlalchemy.Column('id', sqlalchemy.Integer,
-                              sqlalchemy.Sequence('watchtower_alert_id_seq'),
-                              primary_key=True),
-            sqlalchemy.Column('fqid', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('name', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('query_time', sqlalchemy.Integer, nullable=False),
-            sqlalchemy.Column('level', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('method', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('query_expression', sqlalchemy.Text, nullable=False),
-            sqlalchemy.Column('history_query_expression', sqlalchemy.Text,
-                              nullable=False),
-
-            # Violation columns, some of which could be null when no data, back to normal, etc
-            sqlalchemy.Column('time', sqlalchemy.Integer),
-            sqlalchemy.Column('expression', sqlalchemy.Text),
-            sqlalchemy.Column('condition', sqlalchemy.String),
-            sqlalchemy.Column('value', sqlalchemy.Float),
-            sqlalchemy.Column('history_value', sqlalchemy.Float),
-
-            # Metadata columns, which some violations do not have
-            sqlalchemy.Column('meta_type', sqlalchemy.String),
-            sqlalchemy.Column('meta_code', sqlalchemy.String),
-
-            sqlalchemy.UniqueConstraint('fqid', 'time', 'level', 'expression'),
-            sqlalchemy.Index(t_alert_name + '_type_idx', 'meta_type'),
-            sqlalchemy.Index(t_alert_name + '_type_code_idx', 'meta_type', 'meta_code')
-        )
-
-        self.t_error = sqlalchemy.Table(
-            self._table_name('error'),
-            meta,
-            sqlalchemy.Column('id', sqlalchemy.Integer,
-                              sqlalchemy.Sequence('watchtower_error_id_seq'),
-                              primary_key=True),
-            sqlalchemy.Column('fqid', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('name', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('query_time', sqlalchemy.Integer, nullable=False),
-            sqlalchemy.Column('query_expression', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('history_query_expression', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('type', sqlalchemy.String, nullable=False),
-            sqlalchemy.Column('message', sqlalchemy.String, nullable=False),
-            sqlalchemy.UniqueConstraint('fqid', 'query_time', 'query_expression', 'type',
-                                        'message')
-        )
-
-        engine_options = [self.config[n] for n in (
-            'drivername', 'username', 'password', 'host', 'port',
-            'databasename')]
-        if 'sqlite' in engine_options[0] and engine_options[3]:
-            engine_options[3] = '/' + engine_options[3] # host
-
-        self.url = str(sqlalchemy.engine.url.URL(*engine_options))
+        host = self.config['host']
+        if 'sqlite' in self.config['drivername'] and host:
+            # every worker process gets its own sqlite file
+            host = self.shard_path(host)
+        self.url = engine_url(self.config, host)
 
         # Its a little unsafe to log this since it may have a password:
         # logging.debug('Database engine url: %s', self.url)
 
         self.engine = sqlalchemy.create_engine(self.url,
                                                **self.config['engine_params'])
-        meta.create_all(self.engine)
+        dialect = self.engine.dialect.name
+        if self.partitioning is not None:
+            if dialect not in ('postgresql', 'sqlite'):
+                logging.warning("Alert table partitioning is only supported "
+                                "with postgresql and sqlite, not partitioning")
+                self.partitioning = None
+            else:
+                self._check_unpartitioned()
+
+        created = [t for t in (self.t_error, self.t_state) if t is not None]
+        if self.partitioning is None or dialect == 'postgresql':
+            meta.create_all(self.engine, tables=[self.t_alert] + created)
+        else:
+            meta.create_all(self.engine, tables=created)
+        if self.partitioning is None:
+            created.append(self.t_alert)
+        self._create_missing_indexes(created)
+        if self.partitioning is not None:
+            self._init_partitions()
+
+        if self.config['insert_mode'] == 'copy' and \
+                self.engine.dialect.name != 'postgresql':
+            logging.warning("COPY insert mode is only supported by postgresql, "
+                            "falling back to batched inserts")
+            self.config['insert_mode'] = 'insert'
+        if self.t_state is not None and \
+                self.engine.dialect.name not in ('postgresql', 'sqlite'):
+            logging.warning("The alert state table is only supported with "
+                            "postgresql and sqlite, not maintaining it")
+            self.t_state = None
+
+    def _create_missing_indexes(self, tables):
+        # create_all only creates indexes along with their table, so add the
+        # ones that tables created by older versions are missing
+        inspector = sqlalchemy.inspect(self.engine)
+        for table in tables:
+            existing = set(idx['name'] for idx in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    logging.info("Creating index %s (this may take a while on "
+                                 "a large table)" % index.name)
+                    index.create(self.engine)
 
     def _table_name(self, table):
-        suffix = self.config['%s_table_name' % table]
-        return "%s_%s" % (self.config['table_prefix'], suffix) \
-            if self.config['table_prefix'] else suffix
+        return table_name(self.config, table)
+
+    def _check_unpartitioned(self):
+        # an existing plain alert table can't be turned into a partitioned one
+        # in place
+        name = self.t_alert.name
+        if self.engine.dialect.name == 'postgresql':
+            exists = self.engine.execute(sqlalchemy.text(
+                "SELECT 1 FROM pg_class WHERE relname = :name AND relkind = 'r' "
+                "AND pg_table_is_visible(oid)"), name=name).scalar()
+        else:
+            exists = name in sqlalchemy.inspect(self.engine).get_table_names()
+        if exists:
+            raise RuntimeError("Alert table '%s' exists and is not partitioned, "
+                               "rename it (or disable partitioning) first" % name)
+
+    def _partition_table(self, month):
+        # sqlite only
+        table = self.partitions.get(month)
+        if table is None:
+            name = partition_name(self.t_alert.name, month) if month \
+                else self.t_alert.name + '_default'
+            table = alert_table(self.partition_meta, name)
+            table.create(self.engine, checkfirst=True)
+            self._create_missing_indexes([table])
+            self.partitions[month] = table
+        return table
+
+    def _existing_partitions(self):
+        parent = self.t_alert.name
+        if self.engine.dialect.name == 'postgresql':
+            names = [r[0] for r in self.engine.execute(sqlalchemy.text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = :parent AND pg_table_is_visible(p.oid)"),
+                parent=parent)]
+        else:
+            names = sqlalchemy.inspect(self.engine).get_table_names()
+        pattern = re.compile(re.escape(parent) + r'_p(\d{4})(\d{2})$')
+        months = []
+        for name in names:
+            match = pattern.match(name)
+            if match:
+                months.append((int(match.group(1)), int(match.group(2))))
+        return sorted(months)
+
+    def _init_partitions(self):
+        quote = self.engine.dialect.identifier_preparer.quote
+        parent = self.t_alert.name
+        if self.engine.dialect.name == 'postgresql':
+            # catches alerts without a time, or outside the created partitions
+            self.engine.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s "
+                                "DEFAULT" % (quote(parent + '_default'),
+                                             quote(parent)))
+        else:
+            self._partition_table(None)
+            for month in self._existing_partitions():
+                self._partition_table(month)
+            self._update_view()
+        self._maintain_partitions(time.time())
+
+    def _update_view(self):
+        # sqlite: the alert "table" is a view over all the partitions
+        quote = self.engine.dialect.identifier_preparer.quote
+        view = quote(self.t_alert.name)
+        select = " UNION ALL ".join(
+            "SELECT * FROM %s" % quote(self.partitions[m].name)
+            for m in sorted(self.partitions, key=lambda m: m or (0, 0)))
+        with self.engine.begin() as conn:
+            conn.execute("DROP VIEW IF EXISTS %s" % view)
+            conn.execute("CREATE VIEW %s AS %s" % (view, select))
+
+    def _create_partition(self, month):
+        quote = self.engine.dialect.identifier_preparer.quote
+        name = partition_name(self.t_alert.name, month)
+        logging.info("Creating alert partition %s" % name)
+        if self.engine.dialect.name != 'postgresql':
+            self._partition_table(month)
+            return
+        try:
+            self.engine.execute(
+                "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s "
+                "FOR VALUES FROM (%d) TO (%d)" %
+                (quote(name), quote(self.t_alert.name), _month_start(month),
+                 _month_start(_add_months(month, 1))))
+        except sqlalchemy.exc.DBAPIError as e:
+            # e.g., the default partition already holds alerts for this month
+            logging.error("Could not create alert partition %s: %s" % (name, e))
+
+    def _drop_partition(self, month):
+        quote = self.engine.dialect.identifier_preparer.quote
+        name = partition_name(self.t_alert.name, month)
+        logging.info("Dropping alert partition %s" % name)
+        table = self.partitions.pop(month, None)
+        if table is not None:
+            self.partition_meta.remove(table)
+        if self.engine.dialect.name != 'postgresql':
+            # the view must not refer to a table that is gone
+            self._update_view()
+        self.engine.execute("DROP TABLE IF EXISTS %s" % quote(name))
+
+    def _maintain_partitions(self, now):
+        """Create the partitions for the current month and the next `ahead`
+        ones, and drop the ones that are past retention."""
+        self.next_partition_check = now + self.PARTITION_CHECK_INTERVAL
+        current = _month(now)
+        existing = set(self._existing_partitions())
+        created = False
+        for i in range(self.partitioning['ahead'] + 1):
+            month = _add_months(current, i)
+            if month not in existing:
+                self._create_partition(month)
+                created = True
+        if created and self.engine.dialect.name != 'postgresql':
+            self._update_view()
+
+        retention = self.partitioning['retention_months']
+        if retention is not None:
+            oldest = _add_months(current, -retention)
+            for month in sorted(existing):
+                if month < oldest:
+                    self._drop_partition(month)
+
+    def _alert_tables(self, rows):
+        # sqlite partitions are separate tables, so rows are routed here
+        if self.partitioning is None or self.engine.dialect.name == 'postgresql':
+            return [(self.t_alert, rows)]
+        groups = {}
+        for row in rows:
+            month = _month(row['time']) if row['time'] is not None else None
+            groups.setdefault(month, []).append(row)
+        missing = [m for m in groups if m not in self.partitions]
+        for month in missing:
+            self._create_partition(month)
+        if missing:
+            self._update_view()
+        return [(self.partitions[m], g) for m, g in groups.items()]
+
+    def _get_conn(self):
+        # keep using the same pooled connection rather than checking one out
+        # for every insert
+        if self.conn is None or self.conn.closed:
+            self.conn = self.engine.connect()
+        return self.conn
+
+    def _insert_ignore(self, table):
+        # dialect-native "skip rows that violate a unique constraint" insert
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            return sqlalchemy.dialects.postgresql.insert(table)\
+                .on_conflict_do_nothing()
+        if dialect == 'sqlite':
+            return table.insert().prefix_with('OR IGNORE')
+        return None
+
+    def _insert_rows(self, table, rows):
+        ins = self._insert_ignore(table)
+        try:
+            conn = self._get_conn()
+            if ins is not None:
+                conn.execute(ins, rows)
+                return
+            try:
+                conn.execute(table.insert(), rows)
+            except sqlalchemy.exc.IntegrityError:
+                # no native conflict handling, so insert one at a time and skip
+                # only the rows that already exist
+                for row in rows:
+                    try:
+                        conn.execute(table.insert(), row)
+                    except sqlalchemy.exc.IntegrityError as e:
+                        logging.debug("Skipping duplicate row: %s" % e)
+        except sqlalchemy.exc.DBAPIError:
+            # don't hang on to a connection that may be broken
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            raise
+
+    @staticmethod
+    def _copy_value(value):
+        # postgresql COPY text format
+        if value is None:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t')\
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+    def _copy_rows(self, table, rows):
+        quote = self.engine.dialect.identifier_preparer.quote
+        columns = [c.name for c in table.columns if c.name != 'id']
+        cols = ', '.join(quote(c) for c in columns)
+        target = quote(table.name)
+        staging = quote(table.name + '_staging')
+
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(self._copy_value(row.get(c)) for c in columns))
+            buf.write('\n')
+        buf.seek(0)
+
+        try:
+            conn = self._get_conn()
+            with conn.begin():
+                conn.execute("CREATE TEMPORARY TABLE IF NOT EXISTS %s "
+                             "ON COMMIT DELETE ROWS AS SELECT %s FROM %s "
+                             "WITH NO DATA" % (staging, cols, target))
+                cursor = conn.connection.cursor()
+                try:
+                    cursor.copy_expert("COPY %s (%s) FROM STDIN" % (staging, cols),
+                                       buf)
+                finally:
+                    cursor.close()
+                conn.execute("INSERT INTO %s (%s) SELECT %s FROM %s "
+                             "ON CONFLICT DO NOTHING" % (target, cols, cols, staging))
+        except sqlalchemy.exc.DBAPIError:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            raise
+
+    @staticmethod
+    def _build_alert_rows(alert):
+        adict = alert.as_dict()
+        vdicts = adict.pop('violations')
+        for vdict in vdicts:
+            mdict = vdict.pop('meta')
+            if mdict is None:
+                mdict = {
+                    'meta_type': None,
+                    'meta_code': None,
+                }
+            vdict.update({
+                'fqid': adict['fqid'],
+                'name': adict['name'],
+                'level': adict['level'],
+                'query_time': adict['time'],
+                'query_expression': adict['expression'],
+                'history_query_expression': adict['history_expression'],
+                'method': adict['method'],
+                'meta_type': mdict['meta_type'],
+                'meta_code': mdict['meta_code'] if "meta_code" in mdict else None
+            })
+            # get rid of the history column
+            vdict.pop("history")
+        return vdicts
 
     def handle_alert(self, alert):
         logging.debug("DB consumer handling alert")
-        # we need violation annotations, so ensure that has been done
-        alert.annotate_violations()
-        with self.engine.connect() as conn:
-            adict = alert.as_dict()
-            vdicts = adict.pop('violations')
-            for vdict in vdicts:
-                mdict = vdict.pop('meta')
-                if mdict is None:
-                    mdict = {
-                        'meta_type': None,
-                        'meta_code': None,
-                    }
-                vdict.update({
-                    'fqid': adict['fqid'],
-                    'name': adict['name'],
-                    'level': adict['level'],
-                    'query_time': adict['time'],
-                    'query_expression': adict['expression'],
-                    'history_query_expression': adict['history_expression'],
-                    'method': adict['method'],
-                    'meta_type': mdict['meta_type'],
-                    'meta_code': mdict['meta_code'] if "meta_code" in mdict else None
-                })
-                # get rid of the history column
-                vdict.pop("history")
-
-            # dirty hax below. should do a select first
-            try:
-                ins = self.t_alert.insert().values(vdicts)
-                res = conn.execute(ins)
-            except sqlalchemy.exc.IntegrityError as e:
-                logging.warn("Alert insert failed (maybe it already exists?)")
-                logging.debug(e)
+        self._buffer(alert_rows=self._build_alert_rows(alert))
+
+    def handle_alerts(self, alerts):
+        logging.debug("DB consumer handling %d alerts" % len(alerts))
+        rows = []
+        for alert in alerts:
+            rows.extend(self._build_alert_rows(alert))
+        self._buffer(alert_rows=rows)
+
+    def _buffer(self, alert_rows=(), error_rows=()):
+        n_alert_rows, n_error_rows = len(self.alert_rows), len(self.error_rows)
+        self.alert_rows.extend(alert_rows)
+        self.error_rows.extend(error_rows)
+        try:
+            self._maybe_flush(time.time())
+        except Exception:
+            # the caller spools (or gets redelivered) what it just handed us,
+            # so only hang on to the rows of earlier calls for the next flush
+            del self.alert_rows[n_alert_rows:]
+            del self.error_rows[n_error_rows:]
+            raise
+
+    def _maybe_flush(self, now):
+        if len(self.alert_rows) + len(self.error_rows) >= self.config['flush_rows'] or \
+                now - self.last_flush >= self.config['flush_interval']:
+            self.flush()
+
+    def _write_rows(self, table, rows):
+        logging.debug("DB consumer writing %d %s rows" % (len(rows), table.name))
+        if self.config['insert_mode'] == 'copy':
+            self._copy_rows(table, rows)
+        else:
+            self._insert_rows(table, rows)
+
+    def flush(self):
+        # rows are only dropped from the buffers once they are written, so
+        # that a failed flush is retried by the next one (rows that were
+        # already written are skipped by the unique constraints)
+        self.last_flush = time.time()
+        if self.alert_rows:
+            for table, rows in self._alert_tables(self.alert_rows):
+                self._write_rows(table, rows)
+            if self.t_state is not None:
+                self._update_state(self.alert_rows)
+            self.alert_rows = []
+        if self.error_rows:
+            # repeated errors (e.g., a broken query failing every interval)
+            # are skipped by the unique constraint
+            self._write_rows(self.t_error, self.error_rows)
+            self.error_rows = []
+
+    def _state_upsert(self):
+        table = self.t_state
+        cols = ('fqid', 'expression') + self.STATE_COLUMNS
+        if self.engine.dialect.name == 'postgresql':
+            ins = sqlalchemy.dialects.postgresql.insert(table)
+            return ins.on_conflict_do_update(
+                index_elements=['fqid', 'expression'],
+                set_={c: ins.excluded[c] for c in self.STATE_COLUMNS},
+                where=table.c.time <= ins.excluded.time)
+        # sqlalchemy 1.3 can't build a sqlite upsert (sqlite >= 3.24)
+        quote = self.engine.dialect.identifier_preparer.quote
+        return sqlalchemy.text(
+            "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (fqid, expression) "
+            "DO UPDATE SET %s WHERE excluded.time >= %s.time" % (
+                quote(table.name), ', '.join(cols),
+                ', '.join(':' + c for c in cols),
+                ', '.join('%s = excluded.%s' % (c, c) for c in self.STATE_COLUMNS),
+                quote(table.name)))
+
+    def _update_state(self, rows):
+        # only the latest violation of each series in the batch matters
+        latest = {}
+        for row in rows:
+            if row['expression'] is None:
+                continue
+            state = {c: row[c] for c in self.STATE_COLUMNS}
+            state['fqid'] = row['fqid']
+            state['expression'] = row['expression']
+            if state['time'] is None:
+                state['time'] = row['query_time']
+            key = (row['fqid'], row['expression'])
+            if key not in latest or latest[key]['time'] <= state['time']:
+                latest[key] = state
+        if not latest:
+            return
+        try:
+            self._get_conn().execute(self._state_upsert(), list(latest.values()))
+        except sqlalchemy.exc.DBAPIError:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            raise
+
+    @staticmethod
+    def _build_error_row(error):
+        edict = error.as_dict()
+        edict.update({
+            'query_time': edict.pop('time'),
+            'query_expression': edict.pop('expression'),
+            'history_query_expression': edict.pop('history_expression')
+        })
+        return edict
 
     def handle_error(self, error):
         logging.debug("DB consumer handling error")
-        with self.engine.connect() as conn:
-            edict = error.as_dict()
-            edict.update({
-                'query_time': edict.pop('time'),
-                'query_expression': edict.pop('expression'),
-                'history_query_expression': edict.pop('history_expression')
-            })
+        self._buffer(error_rows=[self._build_error_row(error)])
 
-            try:
-                ins = self.t_error.insert().values(**edict)
-                conn.execute(ins)
-            except sqlalchemy.exc.IntegrityError as e:
-                logging.warn("Error insert failed (maybe it already exists?)")
-                logging.debug(e)
+    def handle_errors(self, errors):
+        logging.debug("DB consumer handling %d errors" % len(errors))
+        self._buffer(error_rows=[self._build_error_row(e) for e in errors])
 
     def handle_timer(self, now):
-        pass
+        if self.partitioning is not None and now >= self.next_partition_check:
+            self._maintain_partitions(now)
+        self._maybe_flush(now)
+
+    def stop(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -5,6 +5,9 @@ from watchtower.alert.consumers import AbstractConsumer
 
 class LogConsumer(AbstractConsumer):
 
+    needs_history = False
+    needs_meta = False
+
     loggers = {
         'normal': logging.info,
         'warning': logging.warn,
@@ -1,27 +1,215 @@
+import asyncio
+import collections
+import json
 import logging
+import os
 import slack
 from slack.errors import SlackApiError
+import threading
 import time
 
-from . import AbstractConsumer
+from . import AbstractConsumer, AsyncAbstractConsumer
+from ..ratelimit import TokenBucket
 
 class SlackConsumer(AbstractConsumer):
 
+    needs_history = False
+
     defaults = {
         'api_token': None,
-        'channel': None
+        'channel': None,
+        # when set, violations of alerts with the same name and level that
+        # arrive within coalesce_window seconds are merged into a single
+        # message (add this consumer to timer_consumers so that the last
+        # window is flushed when alerts stop arriving)
+        'coalesce_window': 0,
+        # slack allows at most 50 blocks per message
+        'max_blocks': 50,
+        # messages are queued and sent in the background at no more than
+        # rate_limit messages per second (chat.postMessage allows ~1/s per
+        # channel, with short bursts). when slack rate limits us anyway, the
+        # Retry-After it returns is honoured
+        'rate_limit': 1,
+        'rate_burst': 3,
+        'max_queue': 10000,
+        # messages that fail for reasons other than rate limiting are retried
+        # with exponential backoff, up to max_attempts times
+        'max_attempts': 5,
+        # unsent messages (and those still being coalesced) are saved to
+        # this file on every flush, timer and when stopping, and loaded again
+        # on start. if set to null, kafka offsets are only committed once
+        # every message has been sent, and stopping waits for the queue to
+        # be sent
+        'queue_file': './watchtower-slack-queue.json',
+        # only post violations whose level changed since the last alert for
+        # the same entity, rather than every (repeated) alert
+        'state_changes_only': True,
     }
 
     def __init__(self, config):
-        super(SlackConsumer, self).__init__(self.defaults)
+        super(SlackConsumer, self).__init__(dict(self.defaults))
         if config:
             self.config.update(config)
+        self.state_changes_only = self.config['state_changes_only']
         self.channel = None
         self.client = None
+        # (alert name, level) => {'since': time, 'details': [msg_details]}
+        self.coalesced = collections.OrderedDict()
+
+        # messages waiting to be sent: {'blocks', 'text', 'attempts'}
+        self.outbox = collections.deque()
+        # message being posted by the sender thread
+        self.sending = None
+        self.bucket = TokenBucket(self.config['rate_limit'],
+                                  self.config['rate_burst'])
+        # monotonic time before which nothing may be sent
+        self.throttled_until = 0
+        self.stats = {
+            'sent': 0,
+            'dropped': 0,
+            'ratelimited': 0,
+            'throttled_time': 0.0,
+        }
+
+        self.sender = None
+        self.stopping = False
+        self.outbox_cond = threading.Condition()
 
     def start(self):
         self.channel = self.config['channel']
         self.client = slack.WebClient(token=self.config['api_token'])
+        self._load_queue()
+        self.sender = threading.Thread(target=self._run_sender,
+                                       name='slack-sender', daemon=True)
+        self.sender.start()
+
+    def _load_queue(self):
+        path = self.shard_path(self.config['queue_file'])
+        if not path or not os.path.exists(path):
+            return
+        with open(path) as fh:
+            saved = json.load(fh)
+        if isinstance(saved, list):
+            # written by an older version, only has the outbox
+            saved = {'outbox': saved, 'coalesced': []}
+        self.outbox.extend(saved['outbox'])
+        for group in saved['coalesced']:
+            self.coalesced[(group['name'], group['level'])] = {
+                'since': group['since'], 'details': group['details']}
+        logging.info("Loaded %d queued Slack messages (and %d coalesced "
+                     "groups) from '%s'" %
+                     (len(self.outbox), len(self.coalesced), path))
+
+    def _unsent(self):
+        # queued messages, and the one being posted (if it fails after we
+        # save, it would be lost otherwise)
+        if self.sending is None:
+            return list(self.outbox)
+        return [self.sending] + list(self.outbox)
+
+    def _save_queue(self):
+        path = self.shard_path(self.config['queue_file'])
+        if not path:
+            return
+        saved = {
+            'outbox': self._unsent(),
+            'coalesced': [{'name': name, 'level': level, 'since': group['since'],
+                           'details': group['details']}
+                          for (name, level), group in self.coalesced.items()],
+        }
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(saved, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+
+    def _flush(self):
+        # everything we were handed must be saved, or sent, before the kafka
+        # offsets are committed
+        if self.config['queue_file']:
+            self._save_queue()
+            return True
+        return not self.coalesced and not self._unsent()
+
+    def _enqueue(self, msg_blocks, msg_text):
+        if len(self.outbox) >= self.config['max_queue']:
+            self.outbox.popleft()
+            self.stats['dropped'] += 1
+            logging.error("Slack queue full, dropping oldest message")
+        self.outbox.append({'blocks': msg_blocks, 'text': msg_text,
+                            'attempts': 0})
+
+    def _send_delay(self, now):
+        return max(self.throttled_until - now, self.bucket.delay(now))
+
+    @staticmethod
+    def _retry_after(response):
+        for name, value in response.headers.items():
+            if name.lower() == 'retry-after':
+                return float(value)
+        return 30
+
+    def _post_failed(self, msg, e, now):
+        """Record a failed post, and decide whether it should be retried.
+
+        :return: True if msg should be put back at the head of the queue
+        """
+        if isinstance(e, SlackApiError) and e.response['error'] == 'ratelimited':
+            retry_after = self._retry_after(e.response)
+            logging.warning("Hit slack rate limit. Retrying in %ds." % retry_after)
+            self.throttled_until = now + retry_after
+            self.stats['ratelimited'] += 1
+            return True
+        msg['attempts'] += 1
+        if msg['attempts'] >= self.config['max_attempts']:
+            logging.error("Dropping Slack message after %d attempts: %s" %
+                          (msg['attempts'], e))
+            self.stats['dropped'] += 1
+            return False
+        backoff = min(2 ** msg['attempts'], 300)
+        logging.warning("Slack post failed (%s). Retrying in %ds." % (e, backoff))
+        self.throttled_until = now + backoff
+        return True
+
+    def _run_sender(self):
+        while True:
+            with self.outbox_cond:
+                while not self.outbox and not self.stopping:
+                    self.outbox_cond.wait()
+                if self.stopping and (self.config['queue_file'] or
+                                      not self.outbox):
+                    # whatever is left is saved by stop
+                    return
+                now = time.monotonic()
+                delay = self._send_delay(now)
+                if delay > 0:
+                    self.outbox_cond.wait(delay)
+                    self.stats['throttled_time'] += time.monotonic() - now
+                    continue
+                self.bucket.try_acquire(now)
+                msg = self.sending = self.outbox.popleft()
+            try:
+                self.client.chat_postMessage(
+                    channel=self.channel,
+                    blocks=msg['blocks'],
+                    text=msg['text'],
+                )
+                self.stats['sent'] += 1
+            except Exception as e:
+                with self.outbox_cond:
+                    self.sending = None
+                    if self._post_failed(msg, e, time.monotonic()):
+                        self.outbox.appendleft(msg)
+            finally:
+                with self.outbox_cond:
+                    self.sending = None
+
+    def _log_stats(self):
+        logging.info("Slack: %d queued, %d sent, %d dropped, %d rate limited, "
+                     "%.1fs throttled" %
+                     (len(self.outbox), self.stats['sent'], self.stats['dropped'],
+                      self.stats['ratelimited'], self.stats['throttled_time']))
 
     @staticmethod
     def _build_dashboard_url(meta_type, meta_code, from_time, until_time):
@@ -106,33 +294,111 @@ class SlackConsumer(AbstractConsumer):
                        alert_time)
 
     def _post(self, msg_blocks, msg_text):
-        retries = 5
-        while retries > 0:
-            try:
-                self.client.chat_postMessage(
-                    channel=self.channel,
-                    blocks=msg_blocks,
-                    text=msg_text,
-                )
-            except SlackApiError as e:
-                if e.response['error'] == 'ratelimited':
-                    retries -= 1
-                    if retries == 0:
-                        raise e
-                    logging.warning("Hit slack rate limit. Waiting 30s.")
-                    time.sleep(30)
-                    continue
-                raise e
+        # the sender thread does the actual posting
+        with self.outbox_cond:
+            self._enqueue(msg_blocks, msg_text)
+            self.outbox_cond.notify()
+
+    def _build_digest_blocks(self, details_list, title):
+        blocks = [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": title
+                }
+            },
+        ]
+        for details in details_list:
+            blocks.append({
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "*%s*: %s\n"
+                            "Current Value: %d, Predicted Value: %s, Relative Drop: %s\n"
+                            "%s" % (details['meta_type'].title(), details['meta_code'],
+                                    details['actual'], details['predicted'],
+                                    details['pct_drop'], details['alert_time'])
+                },
+                "accessory": {
+                    "type": "button",
+                    "text": {
+                        "type": "plain_text",
+                        "text": "Show in Dashboard",
+                        "emoji": True
+                    },
+                    "url": self._build_dashboard_url(details['meta_type'],
+                                                     details['meta_code'],
+                                                     details['from_time'],
+                                                     details['until_time'])
+                }
+            })
+        blocks.append({"type": "divider"})
+        return blocks
+
+    def _build_digest_msgs(self, details_list):
+        """Build the (blocks, text) messages for a group of coalesced
+        violations, split so that no message exceeds max_blocks blocks."""
+        if len(details_list) == 1:
+            details = details_list[0]
+            return [(self._build_msg_blocks(**details),
+                     self._build_msg_text(**details))]
+        # each message has a title block and a divider
+        per_msg = self.config['max_blocks'] - 2
+        chunks = [details_list[i:i + per_msg]
+                  for i in range(0, len(details_list), per_msg)]
+        first = details_list[0]
+        msgs = []
+        for part, chunk in enumerate(chunks, 1):
+            title = "*%s*: %s (%d entities)" % (first['position'], first['name'],
+                                                len(details_list))
+            if len(chunks) > 1:
+                title += " [%d/%d]" % (part, len(chunks))
+            text = "%s\n%s" % (title, "\n".join(
+                self._build_msg_text(**details) for details in chunk))
+            msgs.append((self._build_digest_blocks(chunk, title), text))
+        return msgs
+
+    def _coalesce(self, alert, details_list, now):
+        if not details_list:
             return
+        key = (alert.name, alert.level)
+        if key not in self.coalesced:
+            self.coalesced[key] = {'since': now, 'details': []}
+        self.coalesced[key]['details'].extend(details_list)
+
+    def _take_coalesced(self, now, force=False):
+        msgs = []
+        for key in list(self.coalesced):
+            group = self.coalesced[key]
+            if not force and now - group['since'] < self.config['coalesce_window']:
+                continue
+            del self.coalesced[key]
+            msgs.extend(self._build_digest_msgs(group['details']))
+        return msgs
 
     def _send_msg(self, msg_details):
         msg_blocks = self._build_msg_blocks(**msg_details)
         msg_text = self._build_msg_text(**msg_details)
         self._post(msg_blocks, msg_text)
 
+    def _send_msgs(self, msgs):
+        for msg_blocks, msg_text in msgs:
+            self._post(msg_blocks, msg_text)
+
     def handle_alert(self, alert):
         logging.info("Slack handling alert: '%s'" % alert.fqid)
-        alert.annotate_violations()
+        details_list = self._build_alert_details(alert)
+        if not self.config['coalesce_window']:
+            for details in details_list:
+                self._send_msg(details)
+            return
+        now = time.time()
+        self._coalesce(alert, details_list, now)
+        self._send_msgs(self._take_coalesced(now))
+
+    def _build_alert_details(self, alert):
+        msgs = []
         for viol in alert.violations:
             if viol.meta is None:
                 continue
@@ -157,10 +423,151 @@ class SlackConsumer(AbstractConsumer):
                 "pct_drop": pct_drop_str,
                 "alert_time": time.strftime('%m/%d/%Y %H:%M:%S UTC', time.gmtime(viol.time)),
             }
-            self._send_msg(details)
+            msgs.append(details)
+        return msgs
 
     def handle_error(self, error):
         pass
 
+    def flush(self):
+        with self.outbox_cond:
+            return self._flush()
+
     def handle_timer(self, now):
-        pass
\ No newline at end of file
+        self._send_msgs(self._take_coalesced(now))
+        self._log_stats()
+        with self.outbox_cond:
+            self._save_queue()
+
+    def stop(self):
+        self._send_msgs(self._take_coalesced(time.time(), force=True))
+        with self.outbox_cond:
+            self.stopping = True
+            self.outbox_cond.notify()
+            if self.outbox and not self.config['queue_file']:
+                logging.info("Sending %d queued Slack messages before stopping" %
+                             len(self.outbox))
+        if self.sender is not None:
+            self.sender.join()
+        with self.outbox_cond:
+            self._save_queue()
+
+
+class AsyncSlackConsumer(SlackConsumer, AsyncAbstractConsumer):
+    """SlackConsumer for the asyncio runtime. Uses the async Slack client,
+    with up to max_concurrency posts in flight at once."""
+
+    defaults = dict(SlackConsumer.defaults, max_concurrency=10)
+
+    def __init__(self, config):
+        super(AsyncSlackConsumer, self).__init__(config)
+        self.semaphore = None
+        self.outbox_event = None
+        # task => message being posted
+        self.in_flight = {}
+
+    def start(self):
+        self.channel = self.config['channel']
+        self.client = slack.WebClient(token=self.config['api_token'],
+                                      run_async=True)
+        self._load_queue()
+
+    def _ensure_sender(self):
+        # created lazily so that they belong to the running event loop
+        if self.sender is None:
+            self.semaphore = asyncio.Semaphore(self.config['max_concurrency'])
+            self.outbox_event = asyncio.Event()
+            self.sender = asyncio.ensure_future(self._run_sender_async())
+
+    async def _post(self, msg_blocks, msg_text):
+        self._ensure_sender()
+        self._enqueue(msg_blocks, msg_text)
+        self.outbox_event.set()
+
+    async def _run_sender_async(self):
+        while True:
+            if not self.outbox:
+                self.outbox_event.clear()
+                await self.outbox_event.wait()
+                continue
+            now = time.monotonic()
+            delay = self._send_delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                self.stats['throttled_time'] += time.monotonic() - now
+                continue
+            self.bucket.try_acquire(now)
+            msg = self.outbox.popleft()
+            await self.semaphore.acquire()
+            task = asyncio.ensure_future(self._send_queued(msg))
+            self.in_flight[task] = msg
+            task.add_done_callback(lambda t: self.in_flight.pop(t, None))
+
+    async def _send_queued(self, msg):
+        try:
+            await self.client.chat_postMessage(
+                channel=self.channel,
+                blocks=msg['blocks'],
+                text=msg['text'],
+            )
+            self.stats['sent'] += 1
+        except Exception as e:
+            # not in flight any more, only queued (avoids saving it twice)
+            self.in_flight.pop(asyncio.current_task(), None)
+            if self._post_failed(msg, e, time.monotonic()):
+                self.outbox.appendleft(msg)
+                self.outbox_event.set()
+        finally:
+            self.semaphore.release()
+
+    async def _send_msg(self, msg_details):
+        await self._post(self._build_msg_blocks(**msg_details),
+                         self._build_msg_text(**msg_details))
+
+    async def _send_msgs(self, msgs):
+        for msg_blocks, msg_text in msgs:
+            await self._post(msg_blocks, msg_text)
+
+    async def handle_alert(self, alert):
+        logging.info("Slack handling alert: '%s'" % alert.fqid)
+        details_list = self._build_alert_details(alert)
+        if not self.config['coalesce_window']:
+            for details in details_list:
+                await self._send_msg(details)
+            return
+        now = time.time()
+        self._coalesce(alert, details_list, now)
+        await self._send_msgs(self._take_coalesced(now))
+
+    async def handle_alerts(self, alerts):
+        for alert in alerts:
+            await self.handle_alert(alert)
+
+    async def handle_error(self, error):
+        pass
+
+    def _unsent(self):
+        return list(self.in_flight.values()) + list(self.outbox)
+
+    async def flush(self):
+        return self._flush()
+
+    async def handle_timer(self, now):
+        await self._send_msgs(self._take_coalesced(now))
+        self._log_stats()
+        self._save_queue()
+
+    async def stop(self):
+        await self._send_msgs(self._take_coalesced(time.time(), force=True))
+        if not self.config['queue_file'] and self.outbox:
+            logging.info("Sending %d queued Slack messages before stopping" %
+                         len(self.outbox))
+            self._ensure_sender()
+            self.outbox_event.set()
+            while self.outbox or self.in_flight:
+                await asyncio.sleep(0.1)
+        if self.sender is not None:
+            self.sender.cancel()
+            if self.in_flight:
+                await asyncio.gather(*self.in_flight, return_exceptions=True)
+        self._save_queue()
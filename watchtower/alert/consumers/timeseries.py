@@ -1,11 +1,26 @@
+import collections
+import heapq
+import json
 import logging
+import os
+import queue
+import threading
+import time
 import _pytimeseries
 
+# snapshots are written with msgpack when it is installed, json otherwise
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 from . import AbstractConsumer
 
 
 class TimeseriesConsumer(AbstractConsumer):
 
+    needs_history = False
+
     defaults = {
         'interval': 60,
         'backends': ['ascii'],
@@ -14,8 +29,25 @@ class TimeseriesConsumer(AbstractConsumer):
         'level_leaf': 'alert_level',
         'delta_leaf': 'delta_pct_x100',
         'producer_repeat_interval': 7200,  # 2 hours
+        # when alerts for a name resume after a gap, at most this many seconds
+        # of intervals after the last one are flushed (the producer would
+        # have emitted again by then), the rest of the gap is skipped. set to
+        # null to flush every interval of the gap
         'producer_max_interval': 600,
+        # flush KeyPackages on a background thread. the flusher keeps its
+        # own copy of each KeyPackage, updated with the values that changed
+        # since its last flush, so that alerts are never blocked on a flush
+        'background_flush': False,
         'alert_reset_timeout': 7860,
+        # number of (alert fqid, meta fqid) series per alert name whose
+        # KeyPackage indices are cached
+        'key_cache_size': 100000,
+        # if set, the alert state (including KeyPackage contents) is written
+        # to this file before kafka offsets are committed (i.e., on flush),
+        # every checkpoint_interval seconds (from handle_timer) and when
+        # stopping, and restored on start
+        'checkpoint_file': None,
+        'checkpoint_interval': 300,
     }
 
     level_values = {
@@ -25,17 +57,200 @@ class TimeseriesConsumer(AbstractConsumer):
     }
 
     def __init__(self, config):
-        super(TimeseriesConsumer, self).__init__(self.defaults)
+        super(TimeseriesConsumer, self).__init__(dict(self.defaults))
         if config:
             self.config.update(config)
         self.alert_state = {}
         self.ts = None
         self.no_alert_timeout = self.config['alert_reset_timeout']
+        # {(topic, partition): offset} of the last alert applied to the state
+        self.offsets = {}
+        # offsets covered by the restored checkpoint. alerts at or before
+        # these are already reflected in the state and are skipped
+        self.checkpoint_offsets = {}
+        # offsets covered by the last checkpoint written
+        self.written_offsets = {}
+        self.last_checkpoint = time.time()
+
+        self.flusher = None
+        self.flush_queue = None
+        self.flush_stats = {
+            'flushes': 0,
+            'skipped': 0,
+            'time': 0.0,
+            'max_time': 0.0,
+        }
 
     def start(self):
         # [alert.name] => 'int_start', 'last_time', 'kp'
         self._init_ts()
         logging.debug("Missed alert timeout: %s" % self.no_alert_timeout)
+        if self.num_workers > 1:
+            logging.info("Timeseries worker %d/%d: alerts with the same name must "
+                         "all be produced to the same partition" %
+                         (self.worker_id, self.num_workers))
+        if self.config['checkpoint_file']:
+            self._restore_checkpoint()
+        if self.config['background_flush']:
+            self.flush_queue = queue.Queue()
+            self.flusher = threading.Thread(target=self._run_flusher,
+                                            name='timeseries-flush', daemon=True)
+            self.flusher.start()
+
+    def stop(self):
+        if self.flusher is not None:
+            self.flush_queue.put(None)
+            self.flusher.join()
+            self.flusher = None
+        if self.config['checkpoint_file']:
+            self._write_checkpoint()
+
+    def flush(self):
+        # offsets are committed once this returns, so the alerts up to them
+        # must be in a checkpoint, otherwise they are never replayed into
+        # the state after a crash
+        if self.config['checkpoint_file'] and \
+                self.offsets != self.written_offsets:
+            self._write_checkpoint()
+
+    def _run_flusher(self):
+        while True:
+            job = self.flush_queue.get()
+            if job is None:
+                return
+            state, updates, int_start = job
+            try:
+                # only this thread touches flush_kp and flush_index
+                kp = state['flush_kp']
+                if kp is None:
+                    kp = state['flush_kp'] = self.ts.new_keypackage(reset=False)
+                index = state['flush_index']
+                for idx, value in updates.items():
+                    flush_idx = index.get(idx)
+                    if flush_idx is None:
+                        flush_idx = index[idx] = kp.add_key(state['keys'][idx])
+                    kp.set(flush_idx, value)
+                self._do_flush(kp, int_start)
+            except Exception as e:
+                logging.error("Background flush failed")
+                logging.exception(e)
+
+    def _flush(self, state, int_start):
+        if self.flusher is None:
+            self._do_flush(state['kp'], int_start)
+            return
+        # hand the changed values over to the flusher
+        updates = state['dirty']
+        state['dirty'] = {}
+        self.flush_queue.put((state, updates, int_start))
+
+    def _do_flush(self, kp, int_start):
+        start = time.time()
+        kp.flush(int_start)
+        elapsed = time.time() - start
+        self.flush_stats['flushes'] += 1
+        self.flush_stats['time'] += elapsed
+        self.flush_stats['max_time'] = max(self.flush_stats['max_time'], elapsed)
+
+    def _new_state(self, int_start, last_time):
+        return {
+            'int_start': int_start,
+            'last_time': last_time,
+            'kp': self.ts.new_keypackage(reset=False),
+            'violations_last_times': {},  # kp index: violation_last_time
+            # (last_time, kp index) for every index in
+            # violations_last_times, ordered so that stale series can be
+            # found without a scan
+            'expiry': [],
+            # LRU of (alert fqid, meta fqid): (level kp index, delta kp index)
+            'index': collections.OrderedDict(),
+            # kp index: key, and kp index: current value, for checkpoints
+            'keys': {},
+            'values': {},
+            # with background_flush: kp index: value changed since the last
+            # flush was queued, and the flusher's copy of kp (with kp index:
+            # flush_kp index)
+            'dirty': {} if self.config['background_flush'] else None,
+            'flush_kp': None,
+            'flush_index': {},
+        }
+
+    def _write_checkpoint(self):
+        path = self.shard_path(self.config['checkpoint_file'])
+        snapshot = {
+            'version': 1,
+            'offsets': [[topic, partition, offset] for (topic, partition), offset
+                        in self.offsets.items()],
+            'alerts': {},
+        }
+        for name, state in self.alert_state.items():
+            snapshot['alerts'][name] = {
+                'int_start': state['int_start'],
+                'last_time': state['last_time'],
+                'series': [[state['keys'][idx].decode(), value,
+                            state['violations_last_times'].get(idx)]
+                           for idx, value in state['values'].items()],
+            }
+        if msgpack is not None:
+            data = msgpack.packb(snapshot, use_bin_type=True)
+        else:
+            data = json.dumps(snapshot).encode()
+        # write atomically so that a crash never leaves a partial checkpoint
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+        self.last_checkpoint = time.time()
+        self.written_offsets = dict(self.offsets)
+        logging.info("Wrote timeseries checkpoint for %d alerts to '%s'" %
+                     (len(self.alert_state), path))
+
+    def _restore_checkpoint(self):
+        path = self.shard_path(self.config['checkpoint_file'])
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        if data[:1] == b'{':
+            snapshot = json.loads(data.decode())
+        else:
+            snapshot = msgpack.unpackb(data, raw=False)
+        for name, saved in snapshot['alerts'].items():
+            state = self._new_state(saved['int_start'], saved['last_time'])
+            kp = state['kp']
+            for key, value, last_time in saved['series']:
+                key = key.encode()
+                idx = kp.add_key(key)
+                kp.set(idx, value)
+                state['keys'][idx] = key
+                state['values'][idx] = value
+                if last_time is not None:
+                    state['violations_last_times'][idx] = last_time
+                    state['expiry'].append((last_time, idx))
+            heapq.heapify(state['expiry'])
+            if state['dirty'] is not None:
+                state['dirty'].update(state['values'])
+            self.alert_state[name] = state
+        self.checkpoint_offsets = {(topic, partition): offset for
+                                   topic, partition, offset in snapshot['offsets']}
+        self.offsets = dict(self.checkpoint_offsets)
+        self.written_offsets = dict(self.checkpoint_offsets)
+        logging.info("Restored timeseries checkpoint for %d alerts from '%s' "
+                     "(offsets: %s)" % (len(self.alert_state), path,
+                                        self.checkpoint_offsets))
+
+    def _seen(self, alert):
+        """Record the kafka offset of the alert, returning True if it is
+        already included in the restored checkpoint."""
+        if alert.source is None:
+            return False
+        topic, partition, offset = alert.source
+        if offset <= self.checkpoint_offsets.get((topic, partition), -1):
+            return True
+        self.offsets[(topic, partition)] = offset
+        return False
 
     def _init_ts(self):
         logging.info("Initializing PyTimeseries")
@@ -51,54 +266,86 @@ class TimeseriesConsumer(AbstractConsumer):
         logging.debug("Creating new Key Package")
 
     def handle_alert(self, alert):
+        if self._seen(alert):
+            return
         # get the state for this alert type
         if alert.name in self.alert_state:
             state = self.alert_state[alert.name]
         else:
-            state = {
-                'int_start': self.compute_interval_start(alert.time),
-                'last_time': alert.time,
-                'kp': self.ts.new_keypackage(reset=False),
-                'violations_last_times': {}  # violation_idx: violation_last_time
-            }
+            state = self._new_state(self.compute_interval_start(alert.time),
+                                    alert.time)
             self.alert_state[alert.name] = state
 
+        if alert.time < state['last_time']:
+            # its levels are older than the ones already set
+            logging.error('Time is going backwards! Time: %d Last Time: %d'
+                          % (alert.time, state['last_time']))
+            return
         self._maybe_flush_kp(state, alert.time)
 
-        # we need meta, so make sure it is loaded
-        alert.annotate_violations()
-        not_updated_viols = dict(state['violations_last_times'])
+        level_value = self.level_values[alert.level]
+        index = state['index']
+        updates = []
         for v in alert.violations:
             if v.meta is None:
                 continue
+            series = (alert.fqid, v.meta['fqid'])
+            idxs = index.get(series)
+            if idxs is None:
+                idxs = self._add_series(state, series, alert, v)
+            else:
+                index.move_to_end(series)
+            level_idx, delta_idx = idxs
 
-            # create the alert_level metric
-            key = self._build_key(alert, v, self.config['level_leaf'])
-            # logging.debug("Key: %s" % key)
-            idx = state['kp'].get_key(key)
-            if idx is None:
-                idx = state['kp'].add_key(key)
-            state['kp'].set(idx, self.level_values[alert.level])
-            # Update last modified time for this metric
-            state['violations_last_times'][key] = alert.time
-            not_updated_viols.pop(key, None)
+            # the alert_level metric
+            updates.append((level_idx, level_value))
 
-            # create the delta_pct leaf
-            key = self._build_key(alert, v, self.config['delta_leaf'])
-            # logging.debug("Key: %s" % key)
-            idx = state['kp'].get_key(key)
-            if idx is None:
-                idx = state['kp'].add_key(key)
+            # the delta_pct leaf
             delta_pct = 0
             if alert.level != 'normal':
                 # compute percentage drop then * 100 to allow storage in int
                 delta_pct = int((abs(v.history_value - v.value) / max(v.history_value, v.value)) * 100 * 100)
-            state['kp'].set(idx, delta_pct)
-            # Update last modified time for this metric
-            state['violations_last_times'][key] = alert.time
-            not_updated_viols.pop(key, None)
+            updates.append((delta_idx, delta_pct))
+
+        self._set_many(state, updates, alert.time)
+        self._reset_violations_level(state, alert.time)
 
-        self._reset_violations_level(not_updated_viols, state['kp'], alert.time)
+    def _add_series(self, state, series, alert, violation):
+        kp = state['kp']
+        idxs = []
+        for leaf in (self.config['level_leaf'], self.config['delta_leaf']):
+            key = self._build_key(alert, violation, leaf)
+            # the key may already exist if it was evicted from the cache
+            idx = kp.get_key(key)
+            if idx is None:
+                idx = kp.add_key(key)
+                state['keys'][idx] = key
+            idxs.append(idx)
+        idxs = tuple(idxs)
+        index = state['index']
+        index[series] = idxs
+        while len(index) > self.config['key_cache_size']:
+            index.popitem(last=False)
+        return idxs
+
+    @staticmethod
+    def _set_many(state, updates, time):
+        """Apply a batch of (kp index, value) updates, marking each series as
+        updated at the given time."""
+        kp_set = state['kp'].set
+        values = state['values']
+        dirty = state['dirty']
+        last_times = state['violations_last_times']
+        expiry = state['expiry']
+        for idx, value in updates:
+            kp_set(idx, value)
+            values[idx] = value
+            if dirty is not None:
+                dirty[idx] = value
+            # Update last modified time for this metric
+            if idx not in last_times:
+                heapq.heappush(expiry, (time, idx))
+            last_times[idx] = time
 
     def _build_key(self, alert, violation, leaf):
         # "projects.ioda.alerts.[ALERT-FQID].[META-FQID].alert_level
@@ -109,10 +356,6 @@ class TimeseriesConsumer(AbstractConsumer):
 
     def _maybe_flush_kp(self, state, time):
         this_int_start = self.compute_interval_start(time)
-        if time < state['last_time']:
-            logging.error('Time is going backwards! Time: %d Last Time: %d'
-                          % (time, state['last_time']))
-            return
         state['last_time'] = time
         if not state['int_start']:
             state['int_start'] = this_int_start
@@ -120,9 +363,19 @@ class TimeseriesConsumer(AbstractConsumer):
         if this_int_start <= state['int_start']:
             return
 
-        while state['int_start'] < this_int_start:
-            state['kp'].flush(state['int_start'])
-            state['int_start'] += self.config['interval']
+        interval = self.config['interval']
+        n_intervals = (this_int_start - state['int_start']) // interval
+        n_flushes = n_intervals
+        if self.config['producer_max_interval']:
+            n_flushes = min(n_intervals,
+                            max(1, self.config['producer_max_interval'] // interval))
+        for i in range(n_flushes):
+            self._flush(state, state['int_start'] + i * interval)
+        if n_flushes < n_intervals:
+            logging.info("Skipping %d intervals with no alerts"
+                         % (n_intervals - n_flushes))
+            self.flush_stats['skipped'] += n_intervals - n_flushes
+        state['int_start'] = this_int_start
 
     def compute_interval_start(self, time):
         return int(time / self.config['interval']) * self.config['interval']
@@ -136,19 +389,42 @@ class TimeseriesConsumer(AbstractConsumer):
         for name, state in self.alert_state.items():
             logging.debug("Flushing KP for %s" % name)
 
-            self._reset_violations_level(state['violations_last_times'], state['kp'], now)
-            state['kp'].flush(state['int_start'])
+            self._reset_violations_level(state, now)
+            self._flush(state, state['int_start'])
 
-    def _reset_violations_level(self, violations, kp, now):
+        logging.info("Timeseries: %(flushes)d flushes (%(time).2fs total, "
+                     "%(max_time).2fs max), %(skipped)d empty intervals skipped"
+                     % self.flush_stats)
+
+        if self.config['checkpoint_file'] and \
+                now - self.last_checkpoint >= self.config['checkpoint_interval']:
+            self._write_checkpoint()
+
+    def _reset_violations_level(self, state, now):
         """Reset level of a series to normal when no violation of it is received
         for too long, assuming it has came back to normal.
 
-        :param dict violations:
+        Only the series that have expired are visited: the expiry heap holds
+        one entry per tracked series, and entries whose series has been
+        updated since they were pushed are rescheduled when they surface.
+
+        :param dict state:
         :param int now:
         """
         if not self.no_alert_timeout:
             return
-        for key, last_time in violations.items():
-            if now - last_time >= self.no_alert_timeout:
-                idx = kp.get_key(key)
-                kp.set(idx, self.level_values['normal'])
+        expiry = state['expiry']
+        last_times = state['violations_last_times']
+        deadline = now - self.no_alert_timeout
+        while expiry and expiry[0][0] <= deadline:
+            _, idx = heapq.heappop(expiry)
+            last_time = last_times[idx]
+            if last_time > deadline:
+                heapq.heappush(expiry, (last_time, idx))
+                continue
+            # stop tracking the series until it is violated again
+            del last_times[idx]
+            state['kp'].set(idx, self.level_values['normal'])
+            state['values'][idx] = self.level_values['normal']
+            if state['dirty'] is not None:
+                state['dirty'][idx] = self.level_values['normal']
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+
+
+class DedupIndex:
+    """Bounded index of recently seen alerts, used to drop exact duplicates
+    (kafka redelivery, producer retries) before they are annotated and
+    dispatched.
+
+    Alerts are identified by (fqid, time, level, expression). Entries are
+    forgotten once they are more than `window` seconds (of alert time) older
+    than the newest alert seen, or when more than `max_size` are held.
+    """
+
+    defaults = {
+        'max_size': 1000000,
+        'window': 86400,
+    }
+
+    def __init__(self, config=None):
+        self.config = dict(self.defaults)
+        if config:
+            self.config.update(config)
+        self.max_size = self.config['max_size']
+        self.window = self.config['window']
+
+        # key => alert time, in insertion order
+        self._entries = OrderedDict()
+        self.newest = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def seen(self, alert):
+        """Record the alert, returning whether it had already been seen."""
+        key = (alert.fqid, alert.time, alert.level, alert.expression)
+        if key in self._entries:
+            self.duplicates += 1
+            return True
+        self._entries[key] = alert.time
+        if alert.time > self.newest:
+            self.newest = alert.time
+        self._evict()
+        return False
+
+    def _evict(self):
+        entries = self._entries
+        oldest = self.newest - self.window
+        while entries:
+            key, t = next(iter(entries.items()))
+            if len(entries) <= self.max_size and t >= oldest:
+                break
+            del entries[key]
+
+
+class StateTracker:
+    """Tracks the level of every (alert fqid, violation expression) entity so
+    that plugins which only care about state changes (see
+    AbstractConsumer.state_changes_only) are not handed repeats.
+
+    Entities that have not been seen are taken to be normal. Alerts older
+    than the last one seen for an entity (e.g., dead letters being retried)
+    are ignored. At most `max_entities` are tracked, least recently updated
+    first out.
+    """
+
+    defaults = {
+        'max_entities': 1000000,
+    }
+
+    def __init__(self, config=None):
+        self.config = dict(self.defaults)
+        if config:
+            self.config.update(config)
+        self.max_entities = self.config['max_entities']
+
+        # (alert fqid, violation expression) => (level, alert time)
+        self._levels = OrderedDict()
+
+    def __len__(self):
+        return len(self._levels)
+
+    def changes(self, alerts):
+        """Update the tracked levels from the given alerts (in order).
+
+        :return: list of copies of the alerts holding only the violations
+                 whose level changed, alerts without any are left out
+        """
+        levels = self._levels
+        changed = []
+        for alert in alerts:
+            violations = []
+            for viol in alert.violations:
+                key = (alert.fqid, viol.expression)
+                level, last_time = levels.get(key, ('normal', None))
+                if last_time is not None and alert.time < last_time:
+                    # superseded by a newer alert
+                    continue
+                if level != alert.level:
+                    violations.append(viol)
+                levels[key] = (alert.level, alert.time)
+                levels.move_to_end(key)
+            if violations:
+                changed.append(alert.with_violations(violations))
+        while len(levels) > self.max_entities:
+            levels.popitem(last=False)
+        return changed
@@ -0,0 +1,206 @@
+import collections
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+
+class DispatchTicket:
+    """Tracks a batch of kafka messages until every consumer has handled it.
+
+    :param dict offsets: {(topic, partition): last offset} covered by the batch
+    :param int pending: number of consumers that must acknowledge the batch
+    :param bool barrier: whether the ticket tracks a consumer flush rather
+                         than a batch of alerts
+    """
+
+    def __init__(self, offsets, pending, barrier=False):
+        self.offsets = offsets
+        self.pending = pending
+        self.barrier = barrier
+        # set when a consumer failed to flush for a barrier
+        self.failed = False
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self.pending <= 0
+
+    def ack(self):
+        """:return: whether this was the last acknowledgement"""
+        with self._lock:
+            self.pending -= 1
+            return self.pending == 0
+
+    def fail(self):
+        """Acknowledge a barrier whose flush failed. Offsets are not
+        committed up to it, but a later barrier can still commit them."""
+        with self._lock:
+            self.failed = True
+            self.pending -= 1
+
+
+class OffsetTracker:
+    """Keeps tickets in consumption order so that offsets are only committed
+    once a batch, and every batch before it, has been acknowledged and the
+    consumers have flushed it (i.e., a later barrier ticket is done too)."""
+
+    def __init__(self):
+        self.tickets = collections.deque()
+        self.barriers = 0
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def add(self, ticket):
+        self.tickets.append(ticket)
+        if ticket.barrier:
+            self.barriers += 1
+
+    def held_back(self):
+        """Whether a failed (or held back) flush is all that keeps
+        acknowledged tickets from being committed."""
+        for ticket in self.tickets:
+            if not ticket.done:
+                return False
+            if ticket.barrier and ticket.failed:
+                return True
+        return False
+
+    def pop_done(self):
+        """Remove the acknowledged prefix of tickets, up to the last barrier.
+
+        :return: dict of {(topic, partition): offset} that can be committed
+        """
+        end = 0
+        for i, ticket in enumerate(self.tickets):
+            if not ticket.done:
+                break
+            if ticket.barrier and not ticket.failed:
+                end = i + 1
+        offsets = {}
+        for _ in range(end):
+            ticket = self.tickets.popleft()
+            offsets.update(ticket.offsets)
+            if ticket.barrier:
+                self.barriers -= 1
+        return offsets
+
+
+class ConsumerWorker(threading.Thread):
+    """Runs a single consumer plugin on its own thread, fed by a bounded queue.
+
+    Work items are handled in the order they are submitted, so every alert
+    (and so every fqid) reaches the consumer in the order it was consumed.
+    Alerts are shared between workers and must be treated as read-only.
+    """
+
+    def __init__(self, name, consumer, max_queue, metrics=None, on_failure=None,
+                 divert=None):
+        super(ConsumerWorker, self).__init__(name='consumer-%s' % name,
+                                             daemon=True)
+        self.consumer_name = name
+        self.consumer = consumer
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.metrics = metrics
+        # called as on_failure(name, kind, items, exception) when the
+        # consumer fails to handle a batch of alerts/errors. if it raises,
+        # the worker stops handling alerts and leaves the batch unacknowledged
+        self.on_failure = on_failure
+        # called as divert(name, kind, items) before the consumer is handed a
+        # batch of alerts/errors. if it returns True, the batch was taken
+        # care of elsewhere (e.g., spooled behind earlier failures)
+        self.divert = divert
+        # set if the worker gave up on a batch, or the consumer failed to stop
+        # (and so to flush)
+        self.error = None
+        # whether the last flush was held back by the consumer (see
+        # AbstractConsumer.flush)
+        self.waiting = False
+
+    @property
+    def full(self):
+        return self.queue.full()
+
+    def backlog(self):
+        """Fraction of the queue that is in use."""
+        return self.queue.qsize() / self.queue.maxsize
+
+    def submit(self, kind, payload, ticket=None):
+        self.queue.put((kind, payload, ticket))
+
+    def stop(self):
+        """Stop the consumer once the queue has drained.
+
+        :return: whether the consumer stopped (and flushed) cleanly
+        """
+        self.queue.put(('stop', None, None))
+        self.join()
+        return self.error is None
+
+    def run(self):
+        while True:
+            kind, payload, ticket = self.queue.get()
+            if self.error is not None and kind != 'stop':
+                # waiting to be stopped. the tickets are not acknowledged, so
+                # their offsets are not committed
+                continue
+            start = time.perf_counter()
+            profiled = contextlib.nullcontext() if self.metrics is None else \
+                self.metrics.profiler.section()
+            try:
+                with profiled:
+                    if kind in ('alerts', 'errors') and self.divert is not None and \
+                            self.divert(self.consumer_name, kind, payload):
+                        pass
+                    elif kind == 'alerts':
+                        self.consumer.handle_alerts(payload)
+                    elif kind == 'errors':
+                        self.consumer.handle_errors(payload)
+                    elif kind == 'timer':
+                        self.consumer.handle_timer(payload)
+                    elif kind == 'flush':
+                        if self.consumer.flush() is False:
+                            if not self.waiting:
+                                logging.info("Waiting for consumer '%s' before "
+                                             "committing offsets" % self.consumer_name)
+                            self.waiting = True
+                            # not committed, but not an error either
+                            ticket.fail()
+                            ticket = None
+                        else:
+                            self.waiting = False
+                    elif kind == 'call':
+                        # run on this thread, e.g., to retry dead letters
+                        payload()
+                    elif kind == 'stop':
+                        self.consumer.stop()
+                        return
+            except Exception as e:
+                if self.on_failure is not None and kind in ('alerts', 'errors'):
+                    try:
+                        self.on_failure(self.consumer_name, kind, payload, e)
+                    except Exception as e:
+                        logging.error("Consumer '%s' failed to handle %s, "
+                                      "giving up" % (self.consumer_name, kind))
+                        logging.exception(e)
+                        self.error = e
+                        ticket = None
+                else:
+                    logging.error("Consumer '%s' failed to handle %s" %
+                                  (self.consumer_name, kind))
+                    logging.exception(e)
+                if kind == 'flush':
+                    ticket.fail()
+                    ticket = None
+                elif kind == 'stop':
+                    if self.error is None:
+                        self.error = e
+                    return
+            finally:
+                if self.metrics is not None and kind != 'stop':
+                    self.metrics.observe(kind, time.perf_counter() - start,
+                                         self.consumer_name)
+                if ticket is not None:
+                    ticket.ack()
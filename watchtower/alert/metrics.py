@@ -0,0 +1,294 @@
+import bisect
+import cProfile
+import contextlib
+import http.server
+import io
+import logging
+import pstats
+import signal
+import threading
+import time
+import urllib.parse
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket that holds the q-th quantile."""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+
+class Profiler:
+    """Profiles the next N alerts with cProfile, on request.
+
+    Requests may come from any thread (or a signal handler), but profiling is
+    started and stopped by `tick`, which must be called by the thread that
+    polls for alerts. cProfile only profiles the thread that enables it, so
+    other threads that handle alerts (consumer workers and executors) run
+    their work through `section` (or `call`) to be included.
+    """
+
+    # seconds to wait for other threads to finish their profiled work
+    finish_timeout = 10
+
+    def __init__(self, path=None):
+        self.path = path
+        self.requested = 0
+        self.remaining = 0
+        self.profile = None
+        # thread ident => Profile, for the other threads
+        self.thread_profiles = {}
+        # idents of the other threads that are running profiled work
+        self.busy = set()
+        self.cond = threading.Condition()
+
+    @property
+    def active(self):
+        return self.profile is not None
+
+    def request(self, alerts):
+        self.requested = alerts
+
+    def tick(self, handled):
+        if self.profile is not None:
+            self.remaining -= handled
+            if self.remaining <= 0:
+                self._finish()
+        elif self.requested:
+            logging.info("Profiling the next %d alerts" % self.requested)
+            self.remaining = self.requested
+            self.requested = 0
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    @contextlib.contextmanager
+    def section(self):
+        """Profile the work done in the block, if a profile is running."""
+        ident = threading.get_ident()
+        profile = None
+        with self.cond:
+            if self.profile is not None:
+                profile = self.thread_profiles.get(ident)
+                if profile is None:
+                    profile = self.thread_profiles[ident] = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    # python >= 3.12 profiles every thread from tick already
+                    profile = None
+                else:
+                    self.busy.add(ident)
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                with self.cond:
+                    self.busy.discard(ident)
+                    self.cond.notify_all()
+
+    def call(self, func, *args):
+        with self.section():
+            return func(*args)
+
+    def _finish(self):
+        self.profile.disable()
+        profiles = [self.profile]
+        with self.cond:
+            self.profile = None
+            deadline = time.monotonic() + self.finish_timeout
+            while self.busy and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            if self.busy:
+                logging.warning("Profile leaves out %d threads that are still "
+                                "busy" % len(self.busy))
+            profiles.extend(profile for ident, profile in
+                            self.thread_profiles.items()
+                            if ident not in self.busy)
+            self.thread_profiles = {}
+        out = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=out)
+        if self.path:
+            stats.dump_stats(self.path)
+            logging.info("Wrote profile to '%s'" % self.path)
+        stats.sort_stats('cumulative').print_stats(25)
+        logging.info("Profile (%d threads):\n%s" % (len(profiles),
+                                                     out.getvalue()))
+
+
+class Metrics:
+    """Counters and per-stage latency histograms for the alert pipeline.
+
+    Stages are timed with `timer` (or `observe`), optionally per consumer
+    plugin. If `port` is set, the metrics are served in the Prometheus text
+    format at /metrics, and GET /profile?alerts=N asks for the next N alerts
+    to be profiled (as does `profile_signal`). If `log` is set, a summary is
+    logged on every timer tick.
+    """
+
+    defaults = {
+        'host': '',
+        'port': None,
+        'log': False,
+        'profile_alerts': 1000,
+        'profile_path': None,
+        'profile_signal': 'SIGUSR1',
+    }
+
+    def __init__(self, config=None):
+        self.config = dict(self.defaults)
+        if config:
+            self.config.update(config)
+
+        # name => value, only updated by the main thread
+        self.counters = {}
+        # (stage, consumer) => Histogram
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+        self.profiler = Profiler(self.config['profile_path'])
+        self.server = None
+
+    def start(self, worker_id=0):
+        if self.config['profile_signal']:
+            signal.signal(getattr(signal, self.config['profile_signal']),
+                          self._on_profile_signal)
+        if self.config['port'] is not None:
+            # each worker process listens on its own port
+            self._start_server(self.config['port'] + worker_id)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def _on_profile_signal(self, signum, frame):
+        self.profiler.request(self.config['profile_alerts'])
+
+    def _start_server(self, port):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                if url.path == '/metrics':
+                    body = metrics.render()
+                elif url.path == '/profile':
+                    query = urllib.parse.parse_qs(url.query)
+                    alerts = int(query.get('alerts',
+                                           [metrics.config['profile_alerts']])[0])
+                    metrics.profiler.request(alerts)
+                    body = "profiling the next %d alerts\n" % alerts
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics request: " + format % args)
+
+        self.server = http.server.ThreadingHTTPServer(
+            (self.config['host'], port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='metrics', daemon=True)
+        thread.start()
+        logging.info("Serving metrics on port %d" % port)
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds, consumer=None):
+        key = (stage, consumer)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage, consumer=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, consumer)
+
+    @staticmethod
+    def _labels(stage, consumer, **extra):
+        labels = [('stage', stage)]
+        if consumer is not None:
+            labels.append(('consumer', consumer))
+        labels.extend(extra.items())
+        return ",".join('%s="%s"' % label for label in labels)
+
+    def render(self):
+        """Metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append("# TYPE watchtower_alert_%s_total counter" % name)
+            lines.append("watchtower_alert_%s_total %s" % (name, value))
+
+        lines.append("# TYPE watchtower_alert_stage_seconds histogram")
+        with self._lock:
+            hists = sorted(self.histograms.items(),
+                           key=lambda item: (item[0][0], item[0][1] or ''))
+            for (stage, consumer), hist in hists:
+                cumulative = 0
+                for bound, count in zip(hist.buckets + ('+Inf',), hist.counts):
+                    cumulative += count
+                    lines.append("watchtower_alert_stage_seconds_bucket{%s} %d" %
+                                 (self._labels(stage, consumer, le=bound),
+                                  cumulative))
+                labels = self._labels(stage, consumer)
+                lines.append("watchtower_alert_stage_seconds_sum{%s} %f" %
+                             (labels, hist.sum))
+                lines.append("watchtower_alert_stage_seconds_count{%s} %d" %
+                             (labels, hist.count))
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self):
+        logging.info("Counters: %s" % ", ".join(
+            "%s=%s" % item for item in sorted(self.counters.items())))
+        with self._lock:
+            for (stage, consumer), hist in sorted(
+                    self.histograms.items(),
+                    key=lambda item: (item[0][0], item[0][1] or '')):
+                if not hist.count:
+                    continue
+                logging.info("Stage %s%s: %d calls, %.3fs total, mean %.2fms, "
+                             "p50 <= %.1fms, p99 <= %.1fms" %
+                             (stage, " (%s)" % consumer if consumer else "",
+                              hist.count, hist.sum, 1000 * hist.sum / hist.count,
+                              1000 * hist.quantile(0.5),
+                              1000 * hist.quantile(0.99)))
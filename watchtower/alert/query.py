@@ -0,0 +1,115 @@
+import collections
+
+import sqlalchemy
+
+from watchtower.alert.consumers.database import DatabaseConsumer, \
+    define_tables, engine_url
+
+# a page of result rows (as dicts), and the cursor to pass as `after` to get
+# the next page (None on the last page)
+Page = collections.namedtuple('Page', ['rows', 'next'])
+
+
+class AlertQuery:
+    """Read-side queries over the tables written by DatabaseConsumer, for
+    dashboards and APIs.
+
+    Results are paginated by keyset rather than by offset: each Page carries
+    the sort key of its last row, and the next page seeks past it using the
+    table indexes, so later pages cost as much as the first.
+
+    :param config: the DatabaseConsumer config of the database to read
+    """
+
+    def __init__(self, config=None, engine=None):
+        self.config = dict(DatabaseConsumer.defaults)
+        if config:
+            self.config.update(config)
+        tables = define_tables(sqlalchemy.MetaData(), self.config)
+        self.t_alert = tables['alert']
+        self.t_state = tables['state'] if self.config['maintain_state'] else None
+        if engine is None:
+            engine = sqlalchemy.create_engine(engine_url(self.config),
+                                              **self.config['engine_params'])
+        self.engine = engine
+
+    def _page(self, query, keys, limit, after):
+        if after is not None:
+            query = query.where(sqlalchemy.tuple_(*keys) > sqlalchemy.tuple_(*after))
+        query = query.order_by(*keys).limit(limit + 1)
+        with self.engine.connect() as conn:
+            rows = [dict(row) for row in conn.execute(query)]
+        if len(rows) <= limit:
+            return Page(rows, None)
+        rows = rows[:limit]
+        return Page(rows, tuple(rows[-1][k.name] for k in keys))
+
+    def _range(self, query, start, end):
+        t = self.t_alert
+        if start is not None:
+            query = query.where(t.c.time >= start)
+        if end is not None:
+            query = query.where(t.c.time < end)
+        return query
+
+    def history(self, meta_type, meta_code, start=None, end=None, limit=1000,
+                after=None):
+        """Violations of a single entity in [start, end), oldest first."""
+        t = self.t_alert
+        query = sqlalchemy.select([t]).where(sqlalchemy.and_(
+            t.c.meta_type == meta_type, t.c.meta_code == meta_code))
+        return self._page(self._range(query, start, end), [t.c.time, t.c.id],
+                          limit, after)
+
+    def fqid_history(self, fqid, start=None, end=None, limit=1000, after=None):
+        """Violations of a single alert series in [start, end), oldest first."""
+        t = self.t_alert
+        query = sqlalchemy.select([t]).where(t.c.fqid == fqid)
+        return self._page(self._range(query, start, end), [t.c.time, t.c.id],
+                          limit, after)
+
+    def latest_levels(self, fqid=None, meta_type=None, meta_code=None,
+                      active_only=False, limit=1000, after=None):
+        """Latest violation of every (fqid, expression) series, ordered by
+        fqid and expression.
+
+        Read from the state table if the consumer maintains it (see the
+        `maintain_state` option), otherwise worked out from the alert table,
+        which is much slower on a large table.
+
+        :param active_only: leave out the series that are back to normal
+        """
+        if self.t_state is not None:
+            t = self.t_state
+            query = sqlalchemy.select([t])
+        else:
+            t = self.t_alert
+            latest = sqlalchemy.select([
+                t.c.fqid, t.c.expression,
+                sqlalchemy.func.max(t.c.time).label('time')
+            ]).group_by(t.c.fqid, t.c.expression)
+            latest = self._filter(latest, t, fqid, meta_type, meta_code)\
+                .alias('latest')
+            query = sqlalchemy.select([t]).select_from(t.join(
+                latest, sqlalchemy.and_(t.c.fqid == latest.c.fqid,
+                                        t.c.expression == latest.c.expression,
+                                        t.c.time == latest.c.time)))
+        query = self._filter(query, t, fqid, meta_type, meta_code)
+        if active_only:
+            query = query.where(t.c.level != 'normal')
+        return self._page(query, [t.c.fqid, t.c.expression], limit, after)
+
+    def active(self, meta_type=None, meta_code=None, limit=1000, after=None):
+        """Series whose latest level is not normal."""
+        return self.latest_levels(meta_type=meta_type, meta_code=meta_code,
+                                  active_only=True, limit=limit, after=after)
+
+    @staticmethod
+    def _filter(query, t, fqid, meta_type, meta_code):
+        if fqid is not None:
+            query = query.where(t.c.fqid == fqid)
+        if meta_type is not None:
+            query = query.where(t.c.meta_type == meta_type)
+        if meta_code is not None:
+            query = query.where(t.c.meta_code == meta_code)
+        return query
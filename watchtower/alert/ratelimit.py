@@ -0,0 +1,31 @@
+import time
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, with bursts of up to
+    `burst` operations."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def delay(self, now=None):
+        """Seconds until a token will be available."""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def try_acquire(self, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
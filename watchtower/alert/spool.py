@@ -0,0 +1,334 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class DeadLetterBatch:
+    """Records read back from the spool for a retry.
+
+    :param str target: plugin (or stage) the records failed in
+    :param str kind: "alerts" or "errors"
+    :param list records: the spooled records, each holding one alert/error
+                         (as a dict) under 'item'
+    """
+
+    def __init__(self, target, kind, records, end):
+        self.target = target
+        self.kind = kind
+        self.records = records
+        self.items = [r['item'] for r in records]
+        # (segment, offset) just after the last record of the batch
+        self.end = end
+
+
+class _Target:
+    """Spool state of a single target: append-only segment files, plus a
+    read cursor that only moves forward once a retry succeeds."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        segments = self._segments()
+
+        self.cursor = (segments[0] if segments else 0, 0)
+        cursor_file = os.path.join(path, 'cursor')
+        if os.path.exists(cursor_file):
+            with open(cursor_file) as fh:
+                self.cursor = tuple(json.load(fh))
+
+        # a new segment is started on every run, rather than appending to a
+        # segment that may end with a partially written record
+        self.write_seq = (segments[-1] + 1) if segments else 0
+        self.write_fh = None
+        self.write_size = 0
+        self.skip_retried()
+
+        self.in_flight = False
+        self.failures = 0
+        self.next_attempt = 0
+        # retry one record at a time (to isolate a poison record) until a
+        # retry succeeds again
+        self.single = False
+
+    def _segments(self):
+        return sorted(int(f[:-len('.jsonl')]) for f in os.listdir(self.path)
+                      if f.endswith('.jsonl') and f[:-len('.jsonl')].isdigit())
+
+    def skip_retried(self):
+        # remove older segments that have been fully retried, so that the
+        # target isn't taken to be failing
+        seq, offset = self.cursor
+        while seq < self.write_seq:
+            path = self.segment_path(seq)
+            if os.path.exists(path):
+                if offset < os.path.getsize(path):
+                    return
+                os.unlink(path)
+            seq, offset = seq + 1, 0
+            self.set_cursor((seq, offset))
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, '%010d.jsonl' % seq)
+
+    @property
+    def pending(self):
+        seq, offset = self.cursor
+        return seq < self.write_seq or offset < self.write_size
+
+    def append(self, lines, segment_size):
+        if self.write_fh is not None and self.write_size >= segment_size:
+            self.write_fh.close()
+            self.write_fh = None
+            self.write_seq += 1
+            self.write_size = 0
+        if self.write_fh is None:
+            self.write_fh = open(self.segment_path(self.write_seq), 'ab')
+        for line in lines:
+            self.write_fh.write(line)
+            self.write_size += len(line)
+        self.write_fh.flush()
+
+    def sync(self):
+        if self.write_fh is not None:
+            os.fsync(self.write_fh.fileno())
+
+    def close(self):
+        if self.write_fh is not None:
+            self.write_fh.close()
+            self.write_fh = None
+
+    def read(self, max_records):
+        """Read the records after the cursor, moving past (and removing)
+        segments that have been fully retried.
+
+        :return: list of (record, position just after it)
+        """
+        seq, offset = self.cursor
+        while True:
+            if seq > self.write_seq:
+                return []
+            path = self.segment_path(seq)
+            records = []
+            end = offset
+            if os.path.exists(path):
+                with open(path, 'rb') as fh:
+                    fh.seek(offset)
+                    while len(records) < max_records:
+                        line = fh.readline()
+                        # a record is only complete once its newline is there
+                        if not line.endswith(b'\n'):
+                            break
+                        end += len(line)
+                        records.append((json.loads(line), (seq, end)))
+            if records or seq == self.write_seq:
+                return records
+            # an older segment that has been fully retried
+            if os.path.exists(path):
+                os.unlink(path)
+            seq, offset = seq + 1, 0
+            self.set_cursor((seq, offset))
+
+    def set_cursor(self, cursor):
+        self.cursor = cursor
+        tmp = os.path.join(self.path, 'cursor.tmp')
+        with open(tmp, 'w') as fh:
+            json.dump(list(cursor), fh)
+        os.replace(tmp, os.path.join(self.path, 'cursor'))
+
+    def quarantine(self, records):
+        with open(os.path.join(self.path, 'poison.jsonl'), 'ab') as fh:
+            for record in records:
+                fh.write(json.dumps(record).encode() + b'\n')
+
+
+class DeadLetterSpool:
+    """Disk-backed dead-letter queue for alerts (and errors) that a plugin, or
+    the annotation stage, failed to handle.
+
+    Failed items are appended to per-target segment files under `path`. A
+    background drainer reads them back in order and hands batches out
+    through `next_retry` for the Consumer to re-run on the plugin's own thread,
+    backing off exponentially (from `retry_base` up to `retry_max` seconds)
+    while retries keep failing. After a failed batch, records are retried one
+    at a time, and a record that fails `max_attempts` times in a row is moved
+    to the target's poison.jsonl so that it can't block the records behind it.
+    """
+
+    defaults = {
+        'path': './watchtower-dead-letter',
+        'segment_size': 64 << 20,
+        'batch_size': 100,
+        'max_attempts': 10,
+        'retry_base': 5,
+        'retry_max': 600,
+    }
+
+    def __init__(self, config=None):
+        self.config = dict(self.defaults)
+        if config:
+            self.config.update(config)
+        self.path = self.config['path']
+        os.makedirs(self.path, exist_ok=True)
+
+        self.targets = {}
+        for name in sorted(os.listdir(self.path)):
+            if os.path.isdir(os.path.join(self.path, name)):
+                self.targets[name] = _Target(os.path.join(self.path, name))
+
+        self.cond = threading.Condition()
+        # batches that are due for a retry
+        self.ready = []
+        self.stopping = False
+        self.drainer = None
+
+        self.spooled = 0
+        self.retried = 0
+        self.quarantined = 0
+
+    def start(self):
+        backlog = [name for name, t in self.targets.items() if t.pending]
+        if backlog:
+            logging.info("Dead-letter spool has records to retry for: %s" %
+                         ", ".join(backlog))
+        self.drainer = threading.Thread(target=self._run_drainer,
+                                        name='dead-letter', daemon=True)
+        self.drainer.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.drainer is not None:
+            self.drainer.join()
+            self.drainer = None
+        with self.cond:
+            for target in self.targets.values():
+                target.sync()
+                target.close()
+
+    def _target(self, name):
+        target = self.targets.get(name)
+        if target is None:
+            target = self.targets[name] = _Target(os.path.join(self.path, name))
+        return target
+
+    def add(self, target, kind, items, error=None):
+        """Spool items that `target` failed to handle. Thread-safe.
+
+        :param list items: the alerts/errors, as dicts
+        """
+        now = int(time.time())
+        error = repr(error) if error is not None else None
+        lines = [json.dumps({'kind': kind, 'item': item, 'error': error,
+                             'time': now}).encode() + b'\n'
+                 for item in items]
+        with self.cond:
+            self._target(target).append(lines, self.config['segment_size'])
+            self.spooled += len(items)
+            self.cond.notify()
+
+    def failing(self, target):
+        """Whether `target` has records waiting to be retried. Thread-safe."""
+        with self.cond:
+            target = self.targets.get(target)
+            return target is not None and target.pending
+
+    def flush(self):
+        """Make everything spooled so far durable."""
+        with self.cond:
+            for target in self.targets.values():
+                target.sync()
+
+    def next_retry(self):
+        """A batch that is due for a retry, or None. Report the result of the
+        retry with retry_done."""
+        with self.cond:
+            return self.ready.pop(0) if self.ready else None
+
+    def retry_done(self, batch, error=None):
+        with self.cond:
+            target = self.targets[batch.target]
+            target.in_flight = False
+            if error is None:
+                self.retried += len(batch.items)
+                target.set_cursor(batch.end)
+                target.skip_retried()
+                target.failures = 0
+                target.single = False
+                target.next_attempt = 0
+            else:
+                target.failures += 1
+                if len(batch.items) > 1:
+                    target.single = True
+                elif target.failures >= self.config['max_attempts']:
+                    logging.error("Giving up on a dead-letter record for '%s' "
+                                  "after %d attempts: %r" %
+                                  (batch.target, target.failures, error))
+                    target.quarantine(batch.records)
+                    target.set_cursor(batch.end)
+                    target.skip_retried()
+                    self.quarantined += 1
+                    target.failures = 0
+                delay = min(self.config['retry_max'],
+                            self.config['retry_base'] * 2 ** max(0, target.failures - 1))
+                target.next_attempt = time.monotonic() + delay
+                logging.warning("Retry of %d dead-letter records for '%s' "
+                                "failed (%r), next attempt in %ds" %
+                                (len(batch.items), batch.target, error, delay))
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'spooled': self.spooled,
+                'retried': self.retried,
+                'quarantined': self.quarantined,
+                'backlog': [n for n, t in self.targets.items() if t.pending],
+            }
+
+    def _due(self, now):
+        # targets that can be retried now, and how long until the next one can
+        due = []
+        wait = None
+        for name, target in self.targets.items():
+            if target.in_flight or not target.pending:
+                continue
+            if target.next_attempt <= now:
+                due.append(name)
+            else:
+                delay = target.next_attempt - now
+                wait = delay if wait is None else min(wait, delay)
+        return due, wait
+
+    def _run_drainer(self):
+        with self.cond:
+            while not self.stopping:
+                due, wait = self._due(time.monotonic())
+                if not due:
+                    self.cond.wait(wait)
+                    continue
+                for name in due:
+                    target = self.targets[name]
+                    max_records = 1 if target.single else self.config['batch_size']
+                    try:
+                        records = target.read(max_records)
+                    except (OSError, ValueError) as e:
+                        logging.error("Could not read dead-letter spool for '%s'" %
+                                      name)
+                        logging.exception(e)
+                        target.next_attempt = time.monotonic() + self.config['retry_max']
+                        continue
+                    if not records:
+                        continue
+                    # a batch only holds items of one kind
+                    kind = records[0][0]['kind']
+                    for i, (record, _) in enumerate(records):
+                        if record['kind'] != kind:
+                            records = records[:i]
+                            break
+                    target.in_flight = True
+                    self.ready.append(DeadLetterBatch(
+                        name, kind, [r for r, _ in records], records[-1][1]))
+                self.cond.wait(1)
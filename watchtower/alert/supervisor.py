@@ -0,0 +1,151 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from .consumer import Consumer, configure_logging
+
+
+def _run_worker(config_file, worker_id, num_workers, stats_queue):
+    # the supervisor handles ^C for the whole group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # stats that were not sent yet must not keep us from exiting
+    stats_queue.cancel_join_thread()
+    consumer = Consumer(config_file, worker_id=worker_id,
+                        num_workers=num_workers, stats_queue=stats_queue)
+
+    # let the consumer unwind through its normal shutdown path (flushing
+    # buffered rows, saving queues/checkpoints) when the supervisor stops us
+    def _on_term(signum, frame):
+        consumer.stop()
+    signal.signal(signal.SIGTERM, _on_term)
+    consumer.run()
+
+
+class Supervisor:
+    """Runs several Consumer processes in the same consumer group.
+
+    Kafka assigns each worker a share of the topic partitions, so the
+    consumer plugins must tolerate only seeing the alerts of the partitions
+    they were assigned (see AbstractConsumer). Workers that exit are
+    restarted, with a growing delay if they keep failing soon after start.
+    """
+
+    min_uptime = 30
+    max_backoff = 60
+    stats_interval = 60
+    # seconds workers are given to shut down before they are killed
+    stop_timeout = 60
+
+    def __init__(self, config_file, workers):
+        self.config_file = config_file
+        self.num_workers = workers
+        self.stats_queue = multiprocessing.Queue()
+        self.procs = {}
+        self.started = {}
+        self.backoff = {}
+        self.restart_at = {}
+        self.stats = {}
+        self.stopping = False
+
+    def _start(self, worker_id):
+        proc = multiprocessing.Process(
+            target=_run_worker, name='watchtower-alert-%d' % worker_id,
+            args=(self.config_file, worker_id, self.num_workers,
+                  self.stats_queue))
+        proc.start()
+        self.procs[worker_id] = proc
+        self.started[worker_id] = time.monotonic()
+        logging.info("Started worker %d (pid %d)" % (worker_id, proc.pid))
+
+    def _check_workers(self, now):
+        for worker_id, proc in list(self.procs.items()):
+            if proc is None:
+                if now >= self.restart_at[worker_id]:
+                    self._start(worker_id)
+                continue
+            if proc.is_alive():
+                continue
+            proc.join()
+            logging.error("Worker %d (pid %d) exited with code %s" %
+                          (worker_id, proc.pid, proc.exitcode))
+            if now - self.started[worker_id] < self.min_uptime:
+                delay = min(self.max_backoff,
+                            max(1, self.backoff.get(worker_id, 0) * 2))
+            else:
+                delay = 0
+            self.backoff[worker_id] = delay
+            self.restart_at[worker_id] = now + delay
+            self.procs[worker_id] = None
+            if delay:
+                logging.warning("Restarting worker %d in %ds" %
+                                (worker_id, delay))
+
+    def _collect_stats(self, timeout):
+        try:
+            worker_id, stats = self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self.stats[worker_id] = stats
+
+    def _log_stats(self):
+        if not self.stats:
+            return
+        totals = {}
+        for worker_id, stats in sorted(self.stats.items()):
+            logging.info("Worker %d: %s" % (worker_id, ", ".join(
+                "%s=%s" % (k, v) for k, v in sorted(stats.items()))))
+            for k, v in stats.items():
+                totals[k] = totals.get(k, 0) + v
+        logging.info("All workers: %s" % ", ".join(
+            "%s=%s" % (k, v) for k, v in sorted(totals.items())))
+
+    def _stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def _stop_workers(self):
+        for proc in self.procs.values():
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        deadline = time.monotonic() + self.stop_timeout
+        for worker_id, proc in self.procs.items():
+            if proc is None:
+                continue
+            proc.join(max(0, deadline - time.monotonic()))
+            if proc.is_alive():
+                logging.error("Worker %d (pid %d) did not stop within %ds, "
+                              "killing it" % (worker_id, proc.pid,
+                                              self.stop_timeout))
+                proc.kill()
+                proc.join()
+
+    def _configure_logging(self):
+        # workers configure their own logging, the supervisor needs it too
+        # for the worker stats
+        with open(os.path.expanduser(self.config_file)) as fconfig:
+            configure_logging(json.loads(fconfig.read()))
+
+    def run(self):
+        self._configure_logging()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for worker_id in range(self.num_workers):
+            self._start(worker_id)
+        next_stats = time.monotonic() + self.stats_interval
+        try:
+            while not self.stopping:
+                self._collect_stats(timeout=1)
+                now = time.monotonic()
+                if self.stopping:
+                    break
+                self._check_workers(now)
+                if now >= next_stats:
+                    self._log_stats()
+                    next_stats = now + self.stats_interval
+        finally:
+            logging.info("Stopping %d workers" % self.num_workers)
+            self._stop_workers()
+            self._log_stats()